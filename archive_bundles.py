@@ -0,0 +1,236 @@
+# archive_bundles.py
+
+# JSON アーカイブ（{YYYY}/{MM}/ 以下の日次 JSON ファイル）を月ごとの圧縮バンドルにまとめる
+# - {YYYY}/{MM}/bundle.jsonl.gz: 1 行が 1 ファイル分 {"file": 元のキー, "statements": [...]} の gzip 圧縮 JSON Lines
+# - {YYYY}/{MM}/bundle.index: バンドルに含まれる元ファイルのキーとシグネチャの一覧（JSON）
+# インデックスがある月は、ローダーはバンドルと、インデックスに無い日次ファイル（後から届いた分）を読む
+# バンドル作成後に書き換えられた日次ファイル（シグネチャがインデックスと異なるもの）は、バンドルの該当行の代わりに日次ファイルを読む
+# 再度まとめると、書き換えられたファイルの行はバンドル内で作り直される
+# 当月はまだファイルが増えるので、デフォルトではまとめない
+
+#  Options for overriding defaults:
+# - USE_S3 / S3_BUCKET_NAME / LOCAL_JSON_DIR: same as fins_all.py
+# - COMPACT_DELETE_SOURCE: defaults to "false". When "true", deletes the daily files that were rolled into a bundle
+# - COMPACT_CURRENT_MONTH: defaults to "false". When "true", also compacts the current month (JST)
+
+import os
+import io
+import gzip
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+import boto3
+from ingest_manifest import local_file_signature
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+JST = timezone(timedelta(hours=9))
+
+BUNDLE_NAME = "bundle.jsonl.gz"
+INDEX_NAME = "bundle.index"
+
+def is_bundle_key(file_key):
+    return os.path.basename(file_key) == BUNDLE_NAME
+
+def _month_prefix(file_key):
+    # "2024/05/20240510.json" -> "2024/05"
+    return "/".join(file_key.replace(os.sep, "/").split("/")[:2])
+
+def _iter_bundle_entries(fileobj):
+    with gzip.open(fileobj, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry["file"], entry.get("statements", [])
+
+def iter_bundle_statements(fileobj, skip_files=()):
+    # バンドル（gzip 圧縮の JSON Lines）の statements を 1 件ずつ yield する
+    # skip_files の行（バンドル作成後に書き換えられ、日次ファイルから直接読むもの）は読まない
+    for file_key, statements in _iter_bundle_entries(fileobj):
+        if file_key not in skip_files:
+            yield from statements
+
+def rewritten_files(indexed, signatures):
+    # signatures: 現在ある日次ファイル {キー: シグネチャ}。バンドルに含まれているがシグネチャが変わったもののキー
+    return {key for key, signature in signatures.items() if key in indexed and indexed[key] != signature}
+
+def _bundle_bytes(entries):
+    # entries: [(元のキー, statements), ...] をキー順に 1 行ずつ書いた gzip バイト列
+    buffer = io.BytesIO()
+    with gzip.open(buffer, "wt", encoding="utf-8") as f:
+        for file_key, statements in sorted(entries, key=lambda entry: entry[0]):
+            f.write(json.dumps({"file": file_key, "statements": statements}, ensure_ascii=False) + "\n")
+    return buffer.getvalue()
+
+def _index_bytes(signatures):
+    # signatures: {元のキー: シグネチャ（ローカルは mtime:size、S3 は ETag）}
+    return json.dumps({
+        "created_at": datetime.now(JST).isoformat(),
+        "files": [{"key": file_key, "signature": signatures[file_key]} for file_key in sorted(signatures)],
+    }, ensure_ascii=False).encode("utf-8")
+
+def _read_index(fileobj):
+    return {entry["key"]: entry["signature"] for entry in json.load(fileobj).get("files", [])}
+
+# --- Local archive ---
+
+def local_bundle_index(month_path):
+    # 月フォルダのバンドルに含まれる {元ファイルのキー: シグネチャ}。バンドルかインデックスが無ければ None
+    index_path = os.path.join(month_path, INDEX_NAME)
+    if not os.path.exists(index_path) or not os.path.exists(os.path.join(month_path, BUNDLE_NAME)):
+        return None
+    with open(index_path, "r", encoding="utf-8") as f:
+        return _read_index(f)
+
+def local_daily_signatures(month_path):
+    # 月フォルダの日次ファイル {"YYYY/MM/file.json": シグネチャ}
+    prefix = "/".join(os.path.normpath(month_path).split(os.sep)[-2:])
+    return {
+        f"{prefix}/{file}": local_file_signature(os.path.join(month_path, file))
+        for file in sorted(os.listdir(month_path)) if file.endswith(".json")
+    }
+
+def local_rewritten_files(month_path):
+    return rewritten_files(local_bundle_index(month_path) or {}, local_daily_signatures(month_path))
+
+def _write_local_file(path, data):
+    # 一時ファイルに書いてからリネームする
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def compact_local_month(root_folder, year, month, delete_source=False):
+    month_path = os.path.join(root_folder, year, month)
+    bundle_path = os.path.join(month_path, BUNDLE_NAME)
+    indexed = local_bundle_index(month_path) or {}
+
+    # 既存のバンドルの内容に、まだ含まれていない日次ファイルを追加し、書き換えられた日次ファイルの行を作り直す
+    entries = {}
+    if indexed:
+        with open(bundle_path, "rb") as f:
+            entries.update(_iter_bundle_entries(f))
+    signatures = dict(indexed)
+    new_files = []
+    for file_key, signature in local_daily_signatures(month_path).items():
+        if indexed.get(file_key) != signature:
+            file_path = os.path.join(month_path, os.path.basename(file_key))
+            with open(file_path, "r", encoding="utf-8") as f:
+                entries[file_key] = json.load(f).get("statements", [])
+            signatures[file_key] = signature
+            new_files.append(file_path)
+    if not new_files:
+        return 0
+
+    # バンドルを書いてからインデックスを置き換える（インデックスがあるときだけバンドルが使われる）
+    _write_local_file(bundle_path, _bundle_bytes(entries.items()))
+    _write_local_file(os.path.join(month_path, INDEX_NAME), _index_bytes(signatures))
+
+    if delete_source:
+        for file_path in new_files:
+            os.remove(file_path)
+    logging.info(f"📦 Compacted {len(new_files)} files into {bundle_path} ({len(entries)} files in bundle).")
+    return len(new_files)
+
+def compact_local_archive(root_folder, delete_source=False, include_current_month=False):
+    current_month = datetime.now(JST).strftime("%Y/%m")
+    compacted = 0
+    for year in sorted(os.listdir(root_folder)):
+        year_path = os.path.join(root_folder, year)
+        if not os.path.isdir(year_path):
+            continue
+        for month in sorted(os.listdir(year_path)):
+            if not os.path.isdir(os.path.join(year_path, month)):
+                continue
+            if f"{year}/{month}" == current_month and not include_current_month:
+                continue
+            compacted += compact_local_month(root_folder, year, month, delete_source)
+    return compacted
+
+# --- S3 archive ---
+
+def list_s3_objects(s3, bucket_name, prefix=""):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [
+        (obj["Key"], obj["ETag"])
+        for result in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for obj in result.get("Contents", [])
+    ]
+
+def s3_bundle_indexes(s3, bucket_name, keys):
+    # バンドルとインデックスが揃っている月について {月のプレフィックス: {元ファイルのキー: シグネチャ}}
+    keys = set(keys)
+    indexes = {}
+    for key in keys:
+        if is_bundle_key(key) and f"{_month_prefix(key)}/{INDEX_NAME}" in keys:
+            index_obj = s3.get_object(Bucket=bucket_name, Key=f"{_month_prefix(key)}/{INDEX_NAME}")
+            indexes[_month_prefix(key)] = _read_index(index_obj["Body"])
+    return indexes
+
+def s3_rewritten_files(s3, bucket_name, prefix):
+    # prefix（"YYYY/MM"）のバンドルに含まれているが、バンドル作成後に書き換えられた日次ファイルのキー
+    index_obj = s3.get_object(Bucket=bucket_name, Key=f"{prefix}/{INDEX_NAME}")
+    signatures = {key: etag for key, etag in list_s3_objects(s3, bucket_name, f"{prefix}/") if key.endswith(".json")}
+    return rewritten_files(_read_index(index_obj["Body"]), signatures)
+
+def compact_s3_month(s3, bucket_name, prefix, raw_objects, indexed, delete_source=False):
+    # raw_objects: その月の日次ファイル [(キー, ETag), ...] / indexed: 既存のバンドルの {キー: シグネチャ}
+    bundle_key = f"{prefix}/{BUNDLE_NAME}"
+    new_objects = [(key, etag) for key, etag in raw_objects if indexed.get(key) != etag]
+    if not new_objects:
+        return 0
+
+    entries = {}
+    if indexed:
+        bundle_obj = s3.get_object(Bucket=bucket_name, Key=bundle_key)
+        entries.update(_iter_bundle_entries(io.BytesIO(bundle_obj["Body"].read())))
+    signatures = dict(indexed)
+    for key, etag in new_objects:
+        entries[key] = json.load(s3.get_object(Bucket=bucket_name, Key=key)["Body"]).get("statements", [])
+        signatures[key] = etag
+
+    s3.put_object(Bucket=bucket_name, Key=bundle_key, Body=_bundle_bytes(entries.items()), ContentType="application/gzip")
+    s3.put_object(Bucket=bucket_name, Key=f"{prefix}/{INDEX_NAME}", Body=_index_bytes(signatures),
+                  ContentType="application/json")
+
+    if delete_source:
+        for start in range(0, len(new_objects), 1000):
+            s3.delete_objects(Bucket=bucket_name, Delete={
+                "Objects": [{"Key": key} for key, _ in new_objects[start:start + 1000]]
+            })
+    logging.info(f"📦 Compacted {len(new_objects)} objects into s3://{bucket_name}/{bundle_key} ({len(entries)} files in bundle).")
+    return len(new_objects)
+
+def compact_s3_archive(bucket_name, delete_source=False, include_current_month=False):
+    s3 = boto3.client('s3')
+    objects = list_s3_objects(s3, bucket_name)
+    indexes = s3_bundle_indexes(s3, bucket_name, [key for key, _ in objects])
+    current_month = datetime.now(JST).strftime("%Y/%m")
+
+    raw_by_month = {}
+    for key, etag in objects:
+        if key.endswith(".json") and key.count("/") == 2:
+            raw_by_month.setdefault(_month_prefix(key), []).append((key, etag))
+
+    compacted = 0
+    for prefix in sorted(raw_by_month):
+        if prefix == current_month and not include_current_month:
+            continue
+        compacted += compact_s3_month(s3, bucket_name, prefix, raw_by_month[prefix], indexes.get(prefix, {}), delete_source)
+    return compacted
+
+if __name__ == "__main__":
+    use_s3 = os.getenv("USE_S3", "true").lower() == "true"
+    delete_source = os.getenv("COMPACT_DELETE_SOURCE", "false").lower() == "true"
+    include_current_month = os.getenv("COMPACT_CURRENT_MONTH", "false").lower() == "true"
+    logging.info("🚀 Starting archive compaction...")
+    try:
+        if use_s3:
+            count = compact_s3_archive(os.getenv("S3_BUCKET_NAME", "jquants-json"), delete_source, include_current_month)
+        else:
+            count = compact_local_archive(os.getenv("LOCAL_JSON_DIR", "/mnt/c/Users/osamu/OneDrive/jquants_json_data"),
+                                          delete_source, include_current_month)
+        logging.info(f"✅ Archive compaction completed. {count} files rolled into monthly bundles.")
+    except Exception as e:
+        logging.exception(f"Unhandled error: {e}")
@@ -1,12 +1,24 @@
 
 
+import io
 import os
+import logging
+import time
+import threading
+import pandas as pd
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
 
 # Load .env on import
 load_dotenv()
 
+# プロセス内で共有するエンジン（DB URL ごとに 1 つ）
+_engines = {}
+_engines_lock = threading.Lock()
+
 def detect_environment():
     is_heroku = os.getenv("HEROKU_ENV", "false").lower() == "true"
     is_render = os.getenv("RENDER_ENV", "true").lower() == "true"
@@ -31,9 +43,58 @@ def get_database_engine():
         raise ValueError("No database URL found in environment variables.")
 
     db_url = db_url.replace('postgres://', 'postgresql+psycopg2://')
-    engine = create_engine(db_url)
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = create_engine(db_url, **_engine_options())
+            _engines[db_url] = engine
     return engine, environment
 
+def _engine_options():
+    # Options for overriding defaults:
+    # - DB_POOL_SIZE / DB_MAX_OVERFLOW: connection pool size (defaults to 5 / 5)
+    # - DB_POOL_PRE_PING: defaults to "true"
+    # - DB_POOL_RECYCLE: seconds before a pooled connection is recycled (defaults to 1800)
+    # - DB_STATEMENT_TIMEOUT: PostgreSQL statement_timeout in ms (unset = no timeout)
+    options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '5')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+    statement_timeout = os.getenv('DB_STATEMENT_TIMEOUT')
+    if statement_timeout:
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+def dispose_engines():
+    # fork した子プロセスでは親のコネクションを使わないようにプールを破棄する
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=False)
+
+@contextmanager
+def shared_connection():
+    # 複数のステージを 1 本のコネクションで実行する場合に使う（各ステージに engine として渡す）
+    engine, _ = get_database_engine()
+    with engine.connect() as conn:
+        yield conn
+        if conn.in_transaction():
+            conn.commit()
+
+@contextmanager
+def transaction(connectable):
+    # Engine ならプールからコネクションを取得、Connection ならそのまま使い回してトランザクションを張る
+    # Connection の場合、読み込み等で自動開始されたトランザクションは先にコミットする
+    if isinstance(connectable, Connection):
+        if connectable.in_transaction():
+            connectable.commit()
+        with connectable.begin():
+            yield connectable
+    else:
+        with connectable.begin() as conn:
+            yield conn
+
 def get_table_names():
     is_local, is_heroku, is_render = detect_environment()
 
@@ -48,6 +109,263 @@ def get_table_names():
         'fins_all': prefix,
         'fins_all_adjusted': f'{prefix}_adjusted',
         'fins_all_bps_opvalues': f'{prefix}_bps_opvalues',
-        'fins_all_netsales': f'{prefix}_netsales'
+        'fins_all_netsales': f'{prefix}_netsales',
+        'fins_all_growth': f'{prefix}_growth',
+        'fins_all_ttm': f'{prefix}_ttm',
+        'fins_all_manifest': f'{prefix}_manifest'
     }
 
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def infer_sql_type(series):
+    # DataFrame.to_sql と同じ型になるように推定する
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'BIGINT'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'DOUBLE PRECISION'
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return 'TIMESTAMP WITH TIME ZONE'
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return 'TIMESTAMP WITHOUT TIME ZONE'
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ('datetime', 'datetime64'):
+        return 'TIMESTAMP WITHOUT TIME ZONE'
+    if inferred == 'date':
+        return 'DATE'
+    if inferred in ('floating', 'mixed-integer-float'):
+        return 'DOUBLE PRECISION'
+    if inferred == 'integer':
+        return 'BIGINT'
+    if inferred == 'boolean':
+        return 'BOOLEAN'
+    return 'TEXT'
+
+def copy_dataframe(df, table_name, conn, if_exists='replace', column_types=None, chunk_size=100000, create_table=True):
+    # to_sql の代わりに COPY FROM STDIN で一括書き込みする
+    # conn は SQLAlchemy の Connection（トランザクションは呼び出し側で管理）
+    # create_table=False の場合は既存のテーブル（一時テーブルを含む）にそのまま追記する
+    # （CREATE TABLE IF NOT EXISTS は public スキーマで判定するので、一時テーブルと同名の通常テーブルが作られてしまう）
+    column_types = column_types or {}
+    columns = list(df.columns)
+    column_defs = ", ".join(
+        f"{_quote(col)} {column_types.get(col) or infer_sql_type(df[col])}" for col in columns
+    )
+
+    if if_exists == 'replace':
+        conn.execute(text(f"DROP TABLE IF EXISTS {_quote(table_name)}"))
+    elif if_exists != 'append':
+        raise ValueError(f"Unsupported if_exists value: {if_exists}")
+    if create_table:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {_quote(table_name)} ({column_defs})"))
+
+    copy_sql = (
+        f"COPY {_quote(table_name)} ({', '.join(_quote(col) for col in columns)}) "
+        f"FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    )
+    cursor = conn.connection.cursor()
+    try:
+        for start in range(0, len(df), chunk_size):
+            buffer = io.StringIO()
+            df.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False, na_rep='\\N')
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+    finally:
+        cursor.close()
+    logging.info(f"📤 Copied {len(df)} rows into '{table_name}'.")
+
+# 自然キー（upsert の照合キー）
+NATURAL_KEY_COLUMNS = ['seccode', 'docname', 'quarterenddate', 'filingdate']
+
+def _index_specs(index_columns, key_columns):
+    # (インデックス名のサフィックス, カラム) のリスト。自然キーのインデックスは {table}_key
+    specs = [(f"{'_'.join(columns)}_idx", columns) for columns in index_columns or []]
+    if key_columns:
+        specs.append(('key', key_columns))
+    return specs
+
+def _create_index(conn, table_name, suffix, columns, if_not_exists=False):
+    conn.execute(text(
+        f"CREATE INDEX {'IF NOT EXISTS ' if if_not_exists else ''}{_quote(f'{table_name}_{suffix}')} "
+        f"ON {_quote(table_name)} ({', '.join(_quote(col) for col in columns)})"
+    ))
+
+def _rename_table(conn, table_name, new_name, index_specs):
+    conn.execute(text(f"ALTER TABLE {_quote(table_name)} RENAME TO {_quote(new_name)}"))
+    for suffix, _ in index_specs:
+        conn.execute(text(
+            f"ALTER INDEX IF EXISTS {_quote(f'{table_name}_{suffix}')} "
+            f"RENAME TO {_quote(f'{new_name}_{suffix}')}"
+        ))
+
+def _swap_tables(engine, table_name, incoming, outgoing, index_specs, retries=3):
+    # リネームは 1 トランザクションで行う。ACCESS EXCLUSIVE ロックの待ちが長引かないよう lock_timeout を設定し、取れなければリトライ
+    lock_timeout = os.getenv("SWAP_LOCK_TIMEOUT", "5s")
+    for attempt in range(retries):
+        try:
+            with transaction(engine) as conn:
+                conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                conn.execute(text(f"DROP TABLE IF EXISTS {_quote(outgoing)}"))
+                if inspect(conn).has_table(table_name):
+                    _rename_table(conn, table_name, outgoing, index_specs)
+                _rename_table(conn, incoming, table_name, index_specs)
+            return
+        except OperationalError as e:
+            logging.warning(f"Table swap for '{table_name}' failed (attempt {attempt + 1}/{retries}): {e}")
+            if attempt < retries - 1:
+                time.sleep(5)
+            else:
+                raise
+
+def swap_in_dataframe(df, table_name, engine, index_columns=None, key_columns=None, column_types=None):
+    # staging テーブルにロードしてインデックスを作成した後、リネームで本番テーブルと入れ替える
+    # 旧テーブルは {table_name}_old としてロールバック用に残す
+    index_specs = _index_specs(index_columns, key_columns)
+    staging_table = f"{table_name}_stg"
+    previous_table = f"{table_name}_old"
+
+    with transaction(engine) as conn:
+        copy_dataframe(df, staging_table, conn, if_exists='replace', column_types=column_types)
+        for suffix, columns in index_specs:
+            _create_index(conn, staging_table, suffix, columns)
+        conn.execute(text(f"ANALYZE {_quote(staging_table)}"))
+
+    _swap_tables(engine, table_name, staging_table, previous_table, index_specs)
+    logging.info(f"🔀 Swapped '{staging_table}' in as '{table_name}' (previous table kept as '{previous_table}').")
+
+def rollback_table_swap(table_name, engine, index_columns=None, key_columns=None):
+    # 直前の swap_in_dataframe を取り消し、{table_name}_old を本番テーブルに戻す
+    previous_table = f"{table_name}_old"
+    rolled_back_table = f"{table_name}_rolled_back"
+    if not inspect(engine).has_table(previous_table):
+        raise ValueError(f"No previous table '{previous_table}' to roll back to.")
+    _swap_tables(engine, table_name, previous_table, rolled_back_table, _index_specs(index_columns, key_columns))
+    logging.info(f"↩️ Restored '{previous_table}' as '{table_name}'.")
+
+def upsert_dataframe(df, table_name, engine, key_columns, delete_missing=False, scope_column=None,
+                     compare_exclude=('timestamp',)):
+    # staging テーブル経由のマージ。自然キーで照合し、内容が変わった行だけ UPDATE、新しい行だけ INSERT する
+    # delete_missing=True の場合、df に無いキーの行を削除する（scope_column を指定すると df に含まれる値の範囲に限定）
+    # 自然キーが重複する行は最後の 1 行だけを使う（replace モードでは重複行もそのまま書かれる）
+    row_count = len(df)
+    df = df.drop_duplicates(subset=key_columns, keep='last')
+    if len(df) < row_count:
+        logging.warning(f"Dropped {row_count - len(df)} rows with duplicate keys ({', '.join(key_columns)}) "
+                        f"before merging into '{table_name}'.")
+    columns = list(df.columns)
+    value_columns = [col for col in columns if col not in key_columns]
+    compared_columns = [col for col in value_columns if col not in compare_exclude]
+    staging_table = f"{table_name}_upsert"
+
+    # NULL を含まないキーは = で照合（ハッシュ結合が使える）。NULL を含むキーだけ IS NOT DISTINCT FROM
+    key_match = " AND ".join(
+        f"t.{_quote(col)} = s.{_quote(col)}" if df[col].notna().all()
+        else f"t.{_quote(col)} IS NOT DISTINCT FROM s.{_quote(col)}"
+        for col in key_columns
+    )
+    column_list = ", ".join(_quote(col) for col in columns)
+
+    with transaction(engine) as conn:
+        _create_index(conn, table_name, 'key', key_columns, if_not_exists=True)
+        conn.execute(text(f"CREATE TEMP TABLE {_quote(staging_table)} (LIKE {_quote(table_name)}) ON COMMIT DROP"))
+        copy_dataframe(df, staging_table, conn, if_exists='append', create_table=False)
+        conn.execute(text(f"ANALYZE {_quote(staging_table)}"))
+
+        updated = 0
+        if compared_columns:
+            updated = conn.execute(text(f"""
+                UPDATE {_quote(table_name)} t
+                SET {', '.join(f'{_quote(col)} = s.{_quote(col)}' for col in value_columns)}
+                FROM {_quote(staging_table)} s
+                WHERE {key_match}
+                  AND ROW({', '.join(f't.{_quote(col)}' for col in compared_columns)})
+                      IS DISTINCT FROM ROW({', '.join(f's.{_quote(col)}' for col in compared_columns)})
+            """)).rowcount
+
+        inserted = conn.execute(text(f"""
+            INSERT INTO {_quote(table_name)} ({column_list})
+            SELECT {column_list} FROM {_quote(staging_table)} s
+            WHERE NOT EXISTS (SELECT 1 FROM {_quote(table_name)} t WHERE {key_match})
+        """)).rowcount
+
+        deleted = 0
+        if delete_missing:
+            scope = (
+                f"t.{_quote(scope_column)} IN (SELECT DISTINCT {_quote(scope_column)} FROM {_quote(staging_table)})"
+                if scope_column else "TRUE"
+            )
+            deleted = conn.execute(text(f"""
+                DELETE FROM {_quote(table_name)} t
+                WHERE {scope}
+                  AND NOT EXISTS (SELECT 1 FROM {_quote(staging_table)} s WHERE {key_match})
+            """)).rowcount
+
+    logging.info(f"🔁 Merged into '{table_name}': {inserted} inserted, {updated} updated, {deleted} deleted, "
+                 f"{len(df) - inserted - updated} unchanged.")
+
+class FullRecomputeRequired(ValueError):
+    # seccode 単位の入れ替えができない（テーブルが無い・カラムが変わった）ため、テーブル全体の再計算が必要
+    pass
+
+def _table_columns(engine, table_name):
+    return [column['name'] for column in inspect(engine).get_columns(table_name)]
+
+def read_table(table_name, engine, seccodes=None):
+    # seccodes を指定すると、その seccode の行だけを読み込む（差分再計算用）
+    if seccodes is None:
+        return pd.read_sql_table(table_name, engine)
+    query = text(
+        f"SELECT * FROM {_quote(table_name)} WHERE {_quote('seccode')} IN :seccodes"
+    ).bindparams(bindparam('seccodes', expanding=True))
+    return pd.read_sql_query(query, engine, params={'seccodes': list(seccodes)})
+
+def load_stage_input(df, table_name, engine, seccodes=None):
+    # ステージの入力。前のステージの DataFrame が渡されなければ（単体実行時など）table_name から読み込む
+    # seccodes を指定した場合は、その seccode の行だけを読み込む（出力テーブルの同じ seccode の行だけを入れ替えるため）
+    if df is not None:
+        logging.info(f"✅ Using {len(df)} in-memory records from '{table_name}'.")
+        return df
+    logging.info(f"📥 Loading '{table_name}' table{'' if seccodes is None else f' for {len(seccodes)} seccodes'}...")
+    df = read_table(table_name, engine, seccodes)
+    logging.info(f"✅ Loaded {len(df)} records.")
+    return df
+
+def replace_seccode_rows(df, table_name, engine, seccodes):
+    # 指定した seccode の行だけを 1 トランザクションで削除して df の行を入れ直す（他の seccode の行はそのまま）
+    if not inspect(engine).has_table(table_name):
+        raise FullRecomputeRequired(f"Table '{table_name}' does not exist yet.")
+    if set(_table_columns(engine, table_name)) != set(df.columns):
+        raise FullRecomputeRequired(f"Columns of '{table_name}' changed.")
+
+    with transaction(engine) as conn:
+        deleted = conn.execute(
+            text(f"DELETE FROM {_quote(table_name)} WHERE {_quote('seccode')} IN :seccodes")
+            .bindparams(bindparam('seccodes', expanding=True)),
+            {'seccodes': list(seccodes)}
+        ).rowcount
+        copy_dataframe(df, table_name, conn, if_exists='append', create_table=False)
+    logging.info(f"🧩 Replaced rows of {len(seccodes)} seccodes in '{table_name}': {deleted} deleted, {len(df)} inserted.")
+
+def write_table(df, table_name, engine, index_columns=None, key_columns=NATURAL_KEY_COLUMNS, mode=None, seccodes=None,
+                column_types=None):
+    # WRITE_MODE=replace: staging テーブルとの入れ替え / WRITE_MODE=merge: 自然キーでの差分マージ
+    # seccodes を指定した場合は WRITE_MODE に関係なく、その seccode の行だけを入れ替える
+    # column_types: {カラム: SQL の型} で推定した型を上書きする（テーブルを作り直すときだけ使われる。マージ・入れ替えは既存テーブルの型のまま）
+    if seccodes is not None:
+        replace_seccode_rows(df, table_name, engine, seccodes)
+        return
+    mode = (mode or os.getenv("WRITE_MODE", "replace")).lower()
+    if mode == 'merge':
+        if not inspect(engine).has_table(table_name):
+            logging.info(f"Table '{table_name}' does not exist yet. Creating it with a full load.")
+        elif set(_table_columns(engine, table_name)) != set(df.columns):
+            logging.info(f"Columns of '{table_name}' changed. Replacing the table instead of merging.")
+        else:
+            upsert_dataframe(df, table_name, engine, key_columns, delete_missing=True)
+            return
+    elif mode != 'replace':
+        raise ValueError(f"Unsupported WRITE_MODE: {mode}")
+    swap_in_dataframe(df, table_name, engine, index_columns=index_columns, key_columns=key_columns, column_types=column_types)
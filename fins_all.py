@@ -14,33 +14,124 @@
 # - RENDER_ENV: defaults to "false" for saving
 # - USE_S3: defaults to "false" for determining whether to use S3 or local JSON files
 # - S3_BUCKET_NAME: defaults to "jquants-json"
+# - S3_MAX_WORKERS: defaults to "16" concurrent S3 downloads
+# - STATEMENT_CHUNK_SIZE: defaults to "50000" statements per DataFrame chunk
 # - LOCAL_JSON_DIR: defaults to "/mnt/c/Users/osamu/OneDrive/jquants_json_data"
+# - FULL_RELOAD: defaults to "false". When "true", ignores the ingest manifest and replaces fins_all from the whole archive
+# - PIPELINE_MAX_WORKERS: defaults to "1" (serial). When > 1, independent derived stages that are ready at the same time run in that many processes
+# - SHARD_MAX_WORKERS: defaults to "1". When > 1, each derived stage splits its per-seccode computation into shards run in that many processes
+# - WRITE_MODE: defaults to "replace" (staging table swap). "merge" upserts by natural key and only writes changed rows
+# - JQUANTS_CACHE_DIR: defaults to "~/.cache/jquants" for the cached tokens and company master (see jquants_cache.py)
+# - DELTA_MODE: defaults to "false". When "true", fetches the filings for DELTA_DATES from the API instead of reading the JSON archive,
+#   merges them into fins_all and recomputes only the affected seccodes
+# - DELTA_DATES: comma-separated YYYY-MM-DD disclosure dates for DELTA_MODE (defaults to today in JST)
+# - DELTA_ARCHIVE_JSON: defaults to "false". When "true", DELTA_MODE also writes the raw JSON to the archive as {YYYY}/{MM}/{YYYYMMDD}.json in the background
+# Months compacted by archive_bundles.py ({YYYY}/{MM}/bundle.jsonl.gz) are read from the bundle; daily files not yet in the bundle are still read as-is
 
 # fins_all.py
 
 import os
+import io
 import json
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from dotenv import load_dotenv
 import pytz
 from fins_all_adjusted import load_and_process_data
 from fins_all_bps_opvalues import process_and_save_operation_values
 from fins_all_netsales import calculate_and_save_growth_rates
-from db_utils import get_database_engine, get_table_names
+from fins_all_growth import calculate_and_save_metric_growth_rates
+from fins_all_ttm import calculate_and_save_ttm_values
+from db_utils import get_database_engine, get_table_names, write_table, upsert_dataframe, NATURAL_KEY_COLUMNS
 from datetime import datetime, timedelta, timezone
 import logging
 from jquants_api import JQuantsAPI
+from jquants_cache import authenticate, load_company_info
+from stage_runner import Stage, run_scoped, run_stages
+from ingest_manifest import (
+    local_file_signature, load_manifest, filter_new_files, save_manifest, company_list_version, tag_unresolved_files
+)
+from archive_bundles import (
+    BUNDLE_NAME, is_bundle_key, iter_bundle_statements, local_bundle_index, local_daily_signatures, local_rewritten_files,
+    list_s3_objects, s3_bundle_indexes, s3_rewritten_files
+)
 import boto3
+from botocore.config import Config
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # --- Logging setup ---
 JST = timezone(timedelta(hours=9))
 logging.Formatter.converter = lambda *args: datetime.now(JST).timetuple()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def load_statements_from_json(root_folder):
-    all_statements = []
-    total_files = 0
+# J-Quants のフィールド名 -> テーブルのカラム名
+FINS_COLUMN_MAPPING = {
+    'timestamp': 'timestamp',
+    'DisclosedDate': 'filingdate',
+    'TypeOfDocument': 'docname',
+    'LocalCode': 'seccode',
+    'CompanyName': 'companyname',
+    'CurrentFiscalYearEndDate': 'fiscalyearend',
+    'Quarter': 'quarter',
+    'CurrentPeriodEndDate': 'quarterenddate',
+    'TotalAssets': 'totassets',
+    'Equity': 'equity',
+    'NetSales': 'netsales',
+    'OperatingProfit': 'opprofit',
+    'OrdinaryProfit': 'ordprofit',
+    'Profit': 'profit',
+    'EarningsPerShare': 'earningspershare',
+    'ResultDividendPerShareAnnual': 'divannual',
+    'ForecastNetSales': 'fcastnetsales',
+    'ForecastOperatingProfit': 'fcastopprofit',
+    'ForecastOrdinaryProfit': 'fcastordprofit',
+    'ForecastProfit': 'fcastprofit',
+    'ForecastDividendPerShareAnnual': 'fcastdivannual',
+    'NextYearForecastNetSales': 'nextyrfcastnetsales',
+    'NextYearForecastOperatingProfit': 'nextyrfcastopprofit',
+    'NextYearForecastOrdinaryProfit': 'nextyrfcastordprofit',
+    'NextYearForecastProfit': 'nextyrfcastprofit',
+    'NextYearForecastDividendPerShareAnnual': 'nextyrfcastdivannual',
+    'NumberOfIssuedAndOutstandingSharesAtTheEndOfFiscalYearIncludingTreasuryStock': 'issuedsharesincltreasury',
+    'NumberOfTreasuryStockAtTheEndOfFiscalYear': 'treasuryshares',
+    'revisions': 'revisions'
+}
+
+NUMERIC_COLUMNS = [
+    'totassets', 'equity', 'netsales', 'opprofit', 'ordprofit', 'profit', 'earningspershare', 'divannual',
+    'fcastnetsales', 'fcastopprofit', 'fcastordprofit', 'fcastprofit', 'fcastdivannual',
+    'nextyrfcastnetsales', 'nextyrfcastopprofit', 'nextyrfcastordprofit', 'nextyrfcastprofit',
+    'nextyrfcastdivannual', 'issuedsharesincltreasury', 'treasuryshares'
+]
+
+# パース時に残すフィールド（column_mapping の元フィールド + quarter の算出元）
+STATEMENT_FIELDS = [
+    field for field in FINS_COLUMN_MAPPING if field not in ('timestamp', 'Quarter', 'CompanyName', 'revisions')
+] + ['TypeOfCurrentPeriod']
+
+def project_statements(statements, company_dict, on_unknown=None):
+    # Foreign / REIT / 未登録企業をパース時に除外し、必要なフィールドだけを残す
+    # on_unknown(code) は銘柄一覧に無い企業の開示を除外したときに呼ばれる
+    for statement in statements:
+        type_of_document = statement.get("TypeOfDocument", "")
+        if 'Foreign' in type_of_document or 'REIT' in type_of_document:
+            continue
+        company_name = company_dict.get(statement['LocalCode'], 'Unknown')
+        if company_name == 'Unknown':
+            if on_unknown:
+                on_unknown(statement['LocalCode'])
+            continue
+        projected = {field: statement.get(field) for field in STATEMENT_FIELDS}
+        projected['CompanyName'] = company_name
+        yield projected
+
+def list_local_json_files(root_folder):
+    # 月ごとのバンドル（archive_bundles.py）がある月はバンドルを 1 ファイルとして扱い、バンドルに含まれていない日次ファイルと、
+    # バンドル作成後に書き換えられた日次ファイル（シグネチャがインデックスと異なるもの）を追加する
+    files = []
     for year in sorted(os.listdir(root_folder)):
         year_path = os.path.join(root_folder, year)
         if not os.path.isdir(year_path):
@@ -49,60 +140,100 @@ def load_statements_from_json(root_folder):
             month_path = os.path.join(year_path, month)
             if not os.path.isdir(month_path):
                 continue
-            for file in sorted(os.listdir(month_path)):
-                if file.endswith(".json"):
-                    total_files += 1
+            indexed = local_bundle_index(month_path)
+            if indexed is not None:
+                files.append((os.path.join(year, month, BUNDLE_NAME), local_file_signature(os.path.join(month_path, BUNDLE_NAME))))
+            rewritten = 0
+            for daily_key, signature in local_daily_signatures(month_path).items():
+                if indexed is None or indexed.get(daily_key) != signature:
+                    files.append((os.path.join(year, month, os.path.basename(daily_key)), signature))
+                    rewritten += indexed is not None and daily_key in indexed
+            if rewritten:
+                logging.warning(f"⚠️ {rewritten} daily files in {year}/{month} changed after compaction. "
+                                f"Reading them directly until archive_bundles.py is run again.")
+    return files
+
+def _unknown_recorder(unresolved, file_key):
+    # 銘柄一覧に無い企業の開示を含むファイル（または日付）を unresolved に記録するコールバック
+    if unresolved is None:
+        return None
+    return lambda code: unresolved.add(file_key)
+
+def load_statements_from_json(root_folder, company_dict, file_keys=None, unresolved_files=None):
+    if file_keys is None:
+        file_keys = [file_key for file_key, _ in list_local_json_files(root_folder)]
+    total_files = len(file_keys)
     logging.info(f"📂 Found {total_files} JSON files in local folder.")
 
     processed = 0
-    for year in sorted(os.listdir(root_folder)):
-        year_path = os.path.join(root_folder, year)
-        if not os.path.isdir(year_path):
-            continue
-        for month in sorted(os.listdir(year_path)):
-            month_path = os.path.join(year_path, month)
-            if not os.path.isdir(month_path):
-                continue
-            for file in sorted(os.listdir(month_path)):
-                if file.endswith(".json"):
-                    file_path = os.path.join(month_path, file)
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                        statements = data.get("statements", [])
-                        for statement in statements:
-                            if 'Foreign' not in statement.get("TypeOfDocument", "") and 'REIT' not in statement.get("TypeOfDocument", ""):
-                                statement['CompanyName'] = company_dict.get(statement['LocalCode'], 'Unknown')
-                                statement['timestamp'] = datetime.now()
-                                all_statements.append(statement)
-                    processed += 1
-                    if processed % 100 == 0 or processed == total_files:
-                        logging.info(f"✅ Processed {processed}/{total_files} local JSON files...")
-    return all_statements
-
-def load_statements_from_s3(bucket_name):
+    for file_key in file_keys:
+        file_path = os.path.join(root_folder, file_key)
+        on_unknown = _unknown_recorder(unresolved_files, file_key)
+        if is_bundle_key(file_key):
+            # 書き換えられた日次ファイルの行は読まない（日次ファイルの方を読む）
+            skip_files = local_rewritten_files(os.path.dirname(file_path))
+            with open(file_path, "rb") as f:
+                yield from project_statements(iter_bundle_statements(f, skip_files), company_dict, on_unknown)
+        else:
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            yield from project_statements(data.get("statements", []), company_dict, on_unknown)
+        processed += 1
+        if processed % 100 == 0 or processed == total_files:
+            logging.info(f"✅ Processed {processed}/{total_files} local JSON files...")
+
+def _bounded_map(executor, func, items, window):
+    # executor.map と同じく入力順で結果を返すが、先行投入するタスク数を window 件に制限する
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def list_s3_json_objects(bucket_name):
+    # ローカルと同じく、バンドルがある月はバンドルと、バンドルに含まれていない・バンドル作成後に書き換えられた日次ファイルを返す
     s3 = boto3.client('s3')
+    objects = list_s3_objects(s3, bucket_name)
+    indexes = s3_bundle_indexes(s3, bucket_name, [key for key, _ in objects])
+    files = []
+    for key, etag in objects:
+        indexed = indexes.get(key.rsplit("/", 1)[0], {})
+        if is_bundle_key(key) and key.rsplit("/", 1)[0] in indexes:
+            files.append((key, etag))
+        elif key.endswith(".json") and indexed.get(key) != etag:
+            files.append((key, etag))
+            if key in indexed:
+                logging.warning(f"⚠️ {key} changed after compaction. Reading it directly until archive_bundles.py is run again.")
+    return files
+
+def load_statements_from_s3(bucket_name, company_dict, keys=None, max_workers=None, unresolved_files=None):
+    if max_workers is None:
+        max_workers = int(os.getenv("S3_MAX_WORKERS", "16"))
+    s3 = boto3.client('s3', config=Config(max_pool_connections=max_workers))
 
-    paginator = s3.get_paginator('list_objects_v2')
-    all_statements = []
     count = 0
     logging.info(f"📡 Loading JSON files from S3 bucket: {bucket_name}")
-    for result in paginator.paginate(Bucket=bucket_name):
-        for obj in result.get("Contents", []):
-            key = obj["Key"]
-            if key.endswith(".json"):
-                file_obj = s3.get_object(Bucket=bucket_name, Key=key)
-                data = json.load(file_obj["Body"])
-                statements = data.get("statements", [])
-                for statement in statements:
-                    if 'Foreign' not in statement.get("TypeOfDocument", "") and 'REIT' not in statement.get("TypeOfDocument", ""):
-                        statement['CompanyName'] = company_dict.get(statement['LocalCode'], 'Unknown')
-                        statement['timestamp'] = datetime.now()
-                        all_statements.append(statement)
-                count += 1
-                if count % 100 == 0:
-                    logging.info(f"✅ Processed {count} S3 JSON files...")
+    if keys is None:
+        keys = [key for key, _ in list_s3_json_objects(bucket_name)]
+    logging.info(f"📂 Found {len(keys)} JSON files in S3 bucket. Downloading with {max_workers} workers.")
+
+    def read_object(key):
+        file_obj = s3.get_object(Bucket=bucket_name, Key=key)
+        if is_bundle_key(key):
+            # 書き換えられた日次ファイルの行は読まない（日次ファイルの方を読む）
+            skip_files = s3_rewritten_files(s3, bucket_name, key.rsplit("/", 1)[0])
+            return iter_bundle_statements(io.BytesIO(file_obj["Body"].read()), skip_files)
+        return json.load(file_obj["Body"]).get("statements", [])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, statements in zip(keys, _bounded_map(executor, read_object, keys, max_workers * 2)):
+            yield from project_statements(statements, company_dict, _unknown_recorder(unresolved_files, key))
+            count += 1
+            if count % 100 == 0:
+                logging.info(f"✅ Processed {count} S3 JSON files...")
     logging.info(f"📦 Total S3 JSON files processed: {count}")
-    return all_statements
 
 def transform_TypeOfCurrentPeriod(TypeOfCurrentPeriod):
     return TypeOfCurrentPeriod[:-1] if TypeOfCurrentPeriod.endswith('Q') else TypeOfCurrentPeriod
@@ -114,94 +245,231 @@ def find_revisions(doc_name):
         return 'DividendForecastRevision'
     return None
 
-def transform_fins_dataframe(all_data):
-    df = pd.DataFrame(all_data)
+def _transform_chunk(chunk):
+    df = pd.DataFrame(chunk)
     df['revisions'] = df['TypeOfDocument'].apply(find_revisions)
     df['LocalCode'] = df['LocalCode'].str[:4]
     df['quarter'] = df['TypeOfCurrentPeriod'].apply(transform_TypeOfCurrentPeriod)
 
-    column_mapping = {
-        'timestamp': 'timestamp',
-        'DisclosedDate': 'filingdate',
-        'TypeOfDocument': 'docname',
-        'LocalCode': 'seccode',
-        'CompanyName': 'companyname',
-        'CurrentFiscalYearEndDate': 'fiscalyearend',
-        'Quarter': 'quarter',
-        'CurrentPeriodEndDate': 'quarterenddate',
-        'TotalAssets': 'totassets',
-        'Equity': 'equity',
-        'NetSales': 'netsales',
-        'OperatingProfit': 'opprofit',
-        'OrdinaryProfit': 'ordprofit',
-        'Profit': 'profit',
-        'EarningsPerShare': 'earningspershare',
-        'ResultDividendPerShareAnnual': 'divannual',
-        'ForecastNetSales': 'fcastnetsales',
-        'ForecastOperatingProfit': 'fcastopprofit',
-        'ForecastOrdinaryProfit': 'fcastordprofit',
-        'ForecastProfit': 'fcastprofit',
-        'ForecastDividendPerShareAnnual': 'fcastdivannual',
-        'NextYearForecastNetSales': 'nextyrfcastnetsales',
-        'NextYearForecastOperatingProfit': 'nextyrfcastopprofit',
-        'NextYearForecastOrdinaryProfit': 'nextyrfcastordprofit',
-        'NextYearForecastProfit': 'nextyrfcastprofit',
-        'NextYearForecastDividendPerShareAnnual': 'nextyrfcastdivannual',
-        'NumberOfIssuedAndOutstandingSharesAtTheEndOfFiscalYearIncludingTreasuryStock': 'issuedsharesincltreasury',
-        'NumberOfTreasuryStockAtTheEndOfFiscalYear': 'treasuryshares',
-        'revisions': 'revisions'
-    }
-
-    df.rename(columns=column_mapping, inplace=True)
-    missing_cols = [col for col in column_mapping.values() if col not in df.columns]
+    df.rename(columns=FINS_COLUMN_MAPPING, inplace=True)
+    missing_cols = [col for col in FINS_COLUMN_MAPPING.values() if col not in df.columns]
     for col in missing_cols:
         df[col] = None
 
-    df = df[list(column_mapping.values())]
+    df = df[list(FINS_COLUMN_MAPPING.values())]
     df['timestamp'] = datetime.now()
     df['fiscalyearend'] = pd.to_datetime(df['fiscalyearend'], errors='coerce')
     df['filingdate'] = pd.to_datetime(df['filingdate'], errors='coerce')
     df['quarterenddate'] = pd.to_datetime(df['quarterenddate'], errors='coerce')
 
-    numeric_columns = [
-        'totassets', 'equity', 'netsales', 'opprofit', 'ordprofit', 'profit', 'earningspershare', 'divannual',
-        'fcastnetsales', 'fcastopprofit', 'fcastordprofit', 'fcastprofit', 'fcastdivannual',
-        'nextyrfcastnetsales', 'nextyrfcastopprofit', 'nextyrfcastordprofit', 'nextyrfcastprofit',
-        'nextyrfcastdivannual', 'issuedsharesincltreasury', 'treasuryshares'
-    ]
-    for col in numeric_columns:
+    for col in NUMERIC_COLUMNS:
         df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
 
-    df = df[df['companyname'] != 'Unknown']
+    return df[df['companyname'] != 'Unknown']
+
+def transform_fins_dataframe(all_data, chunk_size=None):
+    # all_data はリストでもジェネレータでもよい。chunk_size 件ずつ DataFrame 化して最後に連結する
+    if chunk_size is None:
+        chunk_size = int(os.getenv("STATEMENT_CHUNK_SIZE", "50000"))
+    columns_order = list(FINS_COLUMN_MAPPING.values())
+
+    statements = iter(all_data)
+    chunks = []
+    while True:
+        chunk = list(islice(statements, chunk_size))
+        if not chunk:
+            break
+        chunks.append(_transform_chunk(chunk))
+        logging.info(f"🧱 Transformed chunk {len(chunks)} ({len(chunk)} statements).")
+
+    if not chunks:
+        return pd.DataFrame(columns=columns_order), columns_order
+    df = pd.concat(chunks, ignore_index=True)
 
-    return df, list(column_mapping.values())
+    return df, columns_order
 
 def save_to_database(fins_df, columns_order, engine, environment, tables):
-    with engine.connect() as conn:
-        with conn.begin() as transaction:
-            logging.info(f"Replacing data in {environment} database...")
-            fins_df.to_sql(tables['fins_all'], conn, if_exists='replace', index=False)
-            transaction.commit()
-            logging.info(f"fins_all replaced in {environment} database.")
-
-def process_new_data():
-    try:
-        load_and_process_data()
-        logging.info("fins_all_adjusted completed successfully.")
-    except Exception as e:
-        logging.error(f"Error in load_and_process_data: {e}")
+    logging.info(f"Replacing data in {environment} database...")
+    write_table(fins_df[columns_order], tables['fins_all'], engine, index_columns=[['seccode', 'filingdate']])
+    logging.info(f"fins_all replaced in {environment} database.")
 
-    try:
-        calculate_and_save_growth_rates()
-        logging.info("fins_all_netsales completed successfully.")
-    except Exception as e:
-        logging.error(f"Error in calculate_and_save_growth_rates: {e}")
+def merge_into_database(fins_df, engine, environment, tables):
+    # 新規・変更ファイル分の行だけを、自然キーで既存行とマージする
+    # fins_all がまだ無い場合（新しいデータベースでの最初の差分取り込みなど）は、この行だけでテーブルを作成する
+    if not inspect(engine).has_table(tables['fins_all']):
+        logging.info(f"Table '{tables['fins_all']}' does not exist yet. Creating it with a full load.")
+        save_to_database(fins_df, list(fins_df.columns), engine, environment, tables)
+        return
+    logging.info(f"Merging {len(fins_df)} rows into {environment} database...")
+    upsert_dataframe(fins_df, tables['fins_all'], engine, NATURAL_KEY_COLUMNS)
+    logging.info(f"fins_all merged in {environment} database.")
 
-    try:
-        process_and_save_operation_values()
-        logging.info("fins_all_bps_opvalues completed successfully.")
-    except Exception as e:
-        logging.error(f"Error in process_and_save_operation_values: {e}")
+def process_new_data(fins_df=None, engine=None, max_workers=None, seccodes=None):
+    # 各ステージの出力 DataFrame を次のステージにそのまま渡す（None の場合は各ステージがテーブルから読む）
+    # seccodes を指定すると、その seccode だけを再計算して各テーブルの該当行を入れ替える（派生の計算はすべて seccode ごとに閉じている）
+    # netsales / bps_opvalues / growth / ttm は fins_all_adjusted だけに依存するので、PIPELINE_MAX_WORKERS > 1 なら並列に実行する
+    if max_workers is None:
+        max_workers = int(os.getenv("PIPELINE_MAX_WORKERS", "1"))
+    stages = [
+        Stage('fins_all_adjusted', load_and_process_data, ['fins_all']),
+        Stage('fins_all_netsales', calculate_and_save_growth_rates, ['fins_all_adjusted']),
+        Stage('fins_all_bps_opvalues', process_and_save_operation_values, ['fins_all_adjusted']),
+        Stage('fins_all_growth', calculate_and_save_metric_growth_rates, ['fins_all_adjusted']),
+        Stage('fins_all_ttm', calculate_and_save_ttm_values, ['fins_all_adjusted']),
+    ]
+    # seccodes 指定時、seccode 単位で書き込めないステージ（テーブルが無い・カラムが変わった）はテーブル全体を再計算する
+    stage_kwargs = {}
+    if seccodes is not None:
+        stages = [stage._replace(func=partial(run_scoped, stage.func)) for stage in stages]
+        stage_kwargs['seccodes'] = list(seccodes)
+    # engine（コネクション）はプロセス間で共有できないため、このプロセスで実行するステージにだけ渡す
+    return run_stages(stages, initial_results={'fins_all': fins_df}, max_workers=max_workers,
+                      stage_kwargs=stage_kwargs, local_kwargs={'engine': engine})
+
+def archive_location(use_s3):
+    # JSON アーカイブの場所（S3 バケット名またはローカルフォルダ）と、マニフェストの source 表記
+    if use_s3:
+        bucket = os.getenv("S3_BUCKET_NAME", "jquants-json")
+        return bucket, f"s3://{bucket}"
+    base_folder = os.getenv("LOCAL_JSON_DIR", "/mnt/c/Users/osamu/OneDrive/jquants_json_data")
+    return base_folder, base_folder
+
+def run_archive_load(company_dict, engine, environment, tables, use_s3, full_reload):
+    # JSON アーカイブのうち新規・変更されたファイルを取り込み、派生テーブルを再計算する
+    # 銘柄一覧が空（認証に失敗しキャッシュも無い）の場合は、すべての開示が除外されてしまうので何もしない
+    if not company_dict:
+        logging.error("❌ Company info is empty. Skipping the archive load without touching the manifest.")
+        return
+    location, source = archive_location(use_s3)
+    files = list_s3_json_objects(location) if use_s3 else list_local_json_files(location)
+
+    company_version = company_list_version(company_dict)
+    manifest = {} if full_reload else load_manifest(engine, tables, source)
+    incremental = bool(manifest)
+    new_files = filter_new_files(files, manifest, company_version)
+    logging.info(f"🗂️ {len(new_files)} of {len(files)} JSON files are new or changed ({'incremental' if incremental else 'full'} load).")
+
+    unresolved_files = set()
+    if not new_files:
+        statements = iter(())
+    elif use_s3:
+        statements = load_statements_from_s3(location, company_dict, keys=[key for key, _ in new_files],
+                                             unresolved_files=unresolved_files)
+    else:
+        statements = load_statements_from_json(location, company_dict, file_keys=[key for key, _ in new_files],
+                                               unresolved_files=unresolved_files)
+
+    df, columns_order = transform_fins_dataframe(statements)
+    logging.info(f"✅ Loaded {len(df)} statements.")
+    # 銘柄一覧に無い企業の開示を含むファイルは、銘柄一覧のバージョン付きで記録する（銘柄一覧が変わったら読み直す）
+    if unresolved_files:
+        logging.warning(f"⚠️ {len(unresolved_files)} files contain filings of companies missing from the company info. "
+                        f"They will be read again when the company info changes.")
+    new_files = tag_unresolved_files(new_files, unresolved_files, company_version)
+
+    if not df.empty:
+        # フルロード時は作成済みの DataFrame を渡してすべて再計算する
+        # 差分マージ時は、新規・変更された開示のある seccode だけをテーブルから読んで再計算する
+        if incremental:
+            merge_into_database(df, engine, environment, tables)
+            _, failed = recompute_changed_seccodes(df, engine)
+        else:
+            save_to_database(df, columns_order, engine, environment, tables)
+            _, failed = process_new_data(fins_df=df[columns_order], engine=engine)
+        # マニフェストは派生テーブルの再計算がすべて成功してから記録する
+        # （失敗した場合は次回の実行で同じファイルを取り込み直し、同じ seccode を再計算する）
+        if failed:
+            logging.error(f"❌ Failed stages: {', '.join(sorted(failed))}. "
+                          f"{len(new_files)} files are left out of the manifest and will be retried on the next run.")
+        else:
+            save_manifest(engine, tables, source, new_files, replace=not incremental)
+    else:
+        if new_files:
+            save_manifest(engine, tables, source, new_files, replace=not incremental)
+        logging.info("📭 No statements found to process.")
+
+def recompute_changed_seccodes(df, engine):
+    dirty_seccodes = sorted(df['seccode'].dropna().unique())
+    logging.info(f"🧮 Recomputing derived tables for {len(dirty_seccodes)} changed seccodes.")
+    return process_new_data(engine=engine, seccodes=dirty_seccodes)
+
+def archive_raw_statements(date, data, use_s3):
+    # API から取得した 1 日分の生 JSON を {YYYY}/{MM}/{YYYYMMDD}.json としてアーカイブに保存し、(キー, シグネチャ) を返す
+    # マニフェストへの記録は、派生テーブルの再計算が成功してから呼び出し側で行う
+    location, source = archive_location(use_s3)
+    day = datetime.strptime(date, "%Y-%m-%d")
+    file_key = f"{day:%Y}/{day:%m}/{day:%Y%m%d}.json"
+    body = json.dumps(data, ensure_ascii=False)
+
+    if use_s3:
+        signature = boto3.client('s3').put_object(Bucket=location, Key=file_key, Body=body.encode("utf-8"))["ETag"]
+    else:
+        file_path = os.path.join(location, file_key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        signature = local_file_signature(file_path)
+    logging.info(f"🗄️ Archived {len(data.get('statements', []))} raw statements for {date} to {source}/{file_key}.")
+    return file_key, signature
+
+def fetch_delta_statements(api, dates, company_dict, on_fetched=None, unresolved_dates=None):
+    # 指定日の開示を API から取得し、project_statements を通して 1 件ずつ yield する
+    # on_fetched(date, data) は 1 日分の生データを受け取るコールバック（アーカイブ用）
+    # unresolved_dates には銘柄一覧に無い企業の開示があった日付を記録する
+    for date in dates:
+        data = api.fetch_data(date=date)
+        logging.info(f"📡 Fetched {len(data['statements'])} statements disclosed on {date}.")
+        if on_fetched:
+            on_fetched(date, data)
+        yield from project_statements(data["statements"], company_dict, _unknown_recorder(unresolved_dates, date))
+
+def run_delta_load(api, company_dict, engine, environment, tables, dates, use_s3, archive_json):
+    # JSON アーカイブを経由せずに指定日の開示を API から取得して fins_all にマージし、影響のある seccode だけを再計算する
+    # 生 JSON のアーカイブはバックグラウンドのスレッドで行い、取り込み・再計算を待たせない
+    if not company_dict:
+        logging.error("❌ Company info is empty. Skipping the delta load.")
+        return
+    logging.info(f"📅 Delta load for {', '.join(dates)}.")
+    unresolved_dates = set()
+    with ThreadPoolExecutor(max_workers=1) as archiver:
+        archived = []
+        on_fetched = None
+        if archive_json:
+            on_fetched = lambda date, data: archived.append(
+                (date, archiver.submit(archive_raw_statements, date, data, use_s3))
+            )
+
+        df, columns_order = transform_fins_dataframe(
+            fetch_delta_statements(api, dates, company_dict, on_fetched, unresolved_dates)
+        )
+        logging.info(f"✅ Loaded {len(df)} statements.")
+
+        failed = set()
+        if not df.empty:
+            merge_into_database(df, engine, environment, tables)
+            _, failed = recompute_changed_seccodes(df, engine)
+        else:
+            logging.info("📭 No statements found to process.")
+
+        archived_files = []
+        unresolved_files = set()
+        for date, future in archived:
+            try:
+                archived_files.append(future.result())
+            except Exception as e:
+                logging.error(f"Failed to archive raw statements: {e}")
+                continue
+            if date in unresolved_dates:
+                unresolved_files.add(archived_files[-1][0])
+
+    # アーカイブしたファイルは、再計算がすべて成功した場合だけマニフェストに記録する
+    # （失敗した場合は次回のアーカイブ取り込みで同じファイルを取り込み直し、同じ seccode を再計算する）
+    if failed:
+        logging.error(f"❌ Failed stages: {', '.join(sorted(failed))}. "
+                      f"{len(archived_files)} archived files are left out of the manifest and will be retried by the next archive load.")
+    elif archived_files:
+        save_manifest(engine, tables, archive_location(use_s3)[1],
+                      tag_unresolved_files(archived_files, unresolved_files, company_list_version(company_dict)))
 
 if __name__ == "__main__":
     load_dotenv(dotenv_path="/mnt/c/Users/osamu/OneDrive/onedrive_python_source/.env")
@@ -210,36 +478,31 @@ if __name__ == "__main__":
     PASSWORD = os.getenv("J_QUANTS_PASSWORD")
     api = JQuantsAPI(EMAIL_ADDRESS, PASSWORD)
 
+    # トークンと銘柄一覧はキャッシュを優先し、API が使えない場合も古いキャッシュで続行する
     try:
-        api.get_refresh_token()
-        api.get_id_token()
+        authenticate(api)
+        authenticated = True
     except Exception as e:
         logging.error(f"Failed to authenticate: {e}")
+        authenticated = False
+    try:
+        company_info = load_company_info(api, authenticated)
+        company_dict = {info['Code']: info['CompanyName'] for info in company_info}
+    except Exception as e:
+        logging.error(f"Failed to fetch company info: {e}")
         company_dict = {}
-    else:
-        try:
-            company_info = api.fetch_company_info()
-            company_dict = {info['Code']: info['CompanyName'] for info in company_info}
-        except Exception as e:
-            logging.error(f"Failed to fetch company info: {e}")
-            company_dict = {}
-
-    if use_s3:
-        bucket = os.getenv("S3_BUCKET_NAME", "jquants-json")
-        all_statements = load_statements_from_s3(bucket)
-    else:
-        base_folder = os.getenv("LOCAL_JSON_DIR", "/mnt/c/Users/osamu/OneDrive/jquants_json_data")
-        all_statements = load_statements_from_json(base_folder)
-
-    logging.info(f"✅ Loaded {len(all_statements)} statements.")
 
-    if all_statements:
-        df, columns_order = transform_fins_dataframe(all_statements)
+    engine, environment = get_database_engine()
+    tables = get_table_names()
 
-        engine, environment = get_database_engine()
-        tables = get_table_names()
-
-        save_to_database(df, columns_order, engine, environment, tables)
-        process_new_data()
+    if os.getenv("DELTA_MODE", "false").lower() == "true":
+        dates = [date.strip() for date in os.getenv("DELTA_DATES", "").split(",") if date.strip()]
+        run_delta_load(
+            api, company_dict, engine, environment, tables,
+            dates=dates or [datetime.now(JST).strftime("%Y-%m-%d")],
+            use_s3=use_s3,
+            archive_json=os.getenv("DELTA_ARCHIVE_JSON", "false").lower() == "true"
+        )
     else:
-        logging.info("📭 No statements found to process.")
+        full_reload = os.getenv("FULL_RELOAD", "false").lower() == "true"
+        run_archive_load(company_dict, engine, environment, tables, use_s3, full_reload)
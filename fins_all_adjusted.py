@@ -4,111 +4,80 @@
 import pandas as pd
 from datetime import datetime
 import logging
-from db_utils import get_database_engine, get_table_names
+from db_utils import get_database_engine, get_table_names, load_stage_input, write_table
+from stage_runner import run_sharded
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_and_process_data():
-    logging.info(f"🚀Script 'fins_all_adjusted' started...")
-    # DBエンジン
-    engine, environment = get_database_engine()
-    tables = get_table_names()
+REVISION_DOCNAMES = ['EarnForecastRevision', 'DividendForecastRevision']
 
-    logging.info(f"Loading data from {tables['fins_all']} table...")
-    df = pd.read_sql_table(tables["fins_all"], engine)
-    logging.info(f"✅ Loaded {len(df)} records.")
+# 修正開示の種類ごとに、直前の決算行へ反映するカラムとフラグ
+REVISION_RULES = [
+    ('EarnForecastRevision', ['fcastnetsales', 'fcastopprofit', 'fcastordprofit', 'fcastprofit', 'fcastdivannual'], 'earn_flag'),
+    ('DividendForecastRevision', ['fcastdivannual'], 'div_flag'),
+]
 
-    if df.empty:
-        logging.warning(f"{tables['fins_all']} table is empty.")
+def fold_forecast_revisions(df):
+    # 各 seccode の最終行が EarnForecastRevision / DividendForecastRevision の場合、
+    # その値（ゼロ・空欄以外）を直前の修正以外の行に反映し、filingdate とフラグを更新する
+    # （fiscalyearend が一致する場合のみ。2QとかにFYの修正も載せている会社があるため）
+    # df のインデックスは一意であること
 
     # seccode でグループ化し、filingdate で昇順にソート
     logging.info("Grouping by seccode and sorting by filingdate (ascending)...")
     df_sorted = df.sort_values(['seccode', 'filingdate'], ascending=[True, True])
 
-    # データの読み込み、ソート、グループ化は前と同様
     df_sorted['earn_flag'] = None  # EarnForecastRevision フラグ
     df_sorted['div_flag'] = None   # DividendForecastRevision フラグ
+    logging.info(f"📊 Grouped by seccode. Total unique seccodes: {df_sorted['seccode'].nunique()}")
+
+    has_seccode = df_sorted['seccode'].notna()
+    is_revision = df_sorted['docname'].isin(REVISION_DOCNAMES)
+    is_last = ~df_sorted['seccode'].duplicated(keep='last') & has_seccode
+
+    # 各グループの最終行（修正開示のもの）と、それより前で最後の修正以外の行
+    last_rows = df_sorted[is_last & is_revision]
+    candidates = df_sorted[~is_last & ~is_revision & has_seccode]
+    previous_rows = candidates[~candidates['seccode'].duplicated(keep='last')]
+
+    pairs = last_rows.rename_axis('last_row').reset_index().merge(
+        previous_rows[['seccode', 'fiscalyearend']].rename_axis('prev_row').reset_index(),
+        on='seccode', suffixes=('', '_prev')
+    )
+    pairs = pairs[pairs['fiscalyearend'] == pairs['fiscalyearend_prev']]
+
+    for docname, columns_to_update, flag in REVISION_RULES:
+        revisions = pairs[pairs['docname'] == docname]
+        is_any_field_updated = pd.Series(False, index=revisions.index)
+
+        # ゼロ以外の値で上書き
+        for col in columns_to_update:
+            valid = revisions[col].notna() & (revisions[col] != 0)
+            df_sorted.loc[revisions.loc[valid, 'prev_row'].to_numpy(), col] = revisions.loc[valid, col].to_numpy()
+            is_any_field_updated |= valid
+
+        # いずれかのカラムが更新された場合のみ、filingdate とフラグを更新
+        updated = revisions[is_any_field_updated]
+        df_sorted.loc[updated['prev_row'].to_numpy(), 'filingdate'] = updated['filingdate'].to_numpy()
+        df_sorted.loc[updated['prev_row'].to_numpy(), flag] = 'Updated'
+        logging.info(f"🔁 Applied {len(updated)} {docname} rows to the preceding filings ({flag} set).")
+
+    return df_sorted
+
+def load_and_process_data(df=None, engine=None, seccodes=None):
+    logging.info(f"🚀Script 'fins_all_adjusted' started...")
+    # DBエンジン（引数で渡された場合は共有のエンジン／コネクションを使う）
+    if engine is None:
+        engine, environment = get_database_engine()
+    tables = get_table_names()
 
-    # 各グループの最終行が EarnForecastRevision または DividendForecastRevision である場合、その行をログに出力
-    grouped = df_sorted.groupby('seccode')
-    logging.info(f"📊 Grouped by seccode. Total unique seccodes: {len(grouped)}")
-
-    for seccode, group in grouped:
-        logging.info(f"🔁 Adjusting seccode: {seccode} with {len(group)} rows")
-        last_row = group.iloc[-1]  # 最終行を取得
-
-        # Initialize `previous_value` outside the loop to avoid UnboundLocalError
-        previous_value = None
-
-        # 直前の行を探す
-        previous_row = None
-        for i in range(len(group) - 2, -1, -1):
-            potential_prev_row = group.iloc[i]
-            if potential_prev_row['docname'] not in ['EarnForecastRevision', 'DividendForecastRevision']:
-                previous_row = potential_prev_row
-                break
-
-        # EarnForecastRevision の処理
-        if last_row['docname'] == 'EarnForecastRevision' and previous_row is not None:
-            # quarter が FY であり、かつ fiscalyearend が一致する場合のみ更新
-            if last_row['fiscalyearend'] == previous_row['fiscalyearend']: # test 2QとかにFYの修正も載せている会社があるため
-                columns_to_update = ['fcastnetsales', 'fcastopprofit', 'fcastordprofit', 'fcastprofit', 'fcastdivannual']
-                is_any_field_updated = False  # いずれかのカラムが更新されたかを追跡
-
-                # ゼロ以外の値で上書き
-                for col in columns_to_update:
-                    original_value = last_row[col]
-                    # Only assign `previous_value` if `original_value` is valid to avoid UnboundLocalError
-                    if pd.notnull(original_value) and original_value != 0:
-                        previous_value = previous_row[col]
-                        logging.info(f"Updating {col}: {previous_value} -> {original_value} for seccode {seccode}")
-                        group.at[previous_row.name, col] = original_value  # previous_row を更新
-                        is_any_field_updated = True  # いずれかのカラムが更新されたことを記録
-                    else:
-                        # `previous_value` is safely used here because it is initialized as None
-                        logging.info(f"No update for {col}: {previous_value} (Original: {original_value}) for seccode {seccode}")
-
-                # いずれかのカラムが更新された場合のみ、filingdate を更新
-                if is_any_field_updated:
-                    logging.info(f"Updating filingdate: {previous_row['filingdate']} -> {last_row['filingdate']} for seccode {seccode}")
-                    group.at[previous_row.name, 'filingdate'] = last_row['filingdate']
-                    # Earn_flag を設定
-                    group.at[previous_row.name, 'earn_flag'] = 'Updated'
-                    logging.info(f"earn_flag set for seccode {seccode}, row {previous_row.name}")
-                    
-        # DividendForecastRevision の処理
-        elif last_row['docname'] == 'DividendForecastRevision' and previous_row is not None:
-            # quarter が FY であり、かつ fiscalyearend が一致する場合のみ更新
-            if last_row['fiscalyearend'] == previous_row['fiscalyearend']: # test QとかにFYの修正も載せている会社があるため
-                columns_to_update = ['fcastdivannual']
-                is_any_field_updated = False  # いずれかのカラムが更新されたかを追跡
-
-                # ゼロ以外の値で上書き
-                for col in columns_to_update:
-                    original_value = last_row[col]
-                    # Assign `previous_value` here for dividend updates
-                    previous_value = previous_row[col]  # Initialize `previous_value` here
-                    logging.info(f"Checking column {col} for seccode {seccode}, Original: {original_value}, Previous: {previous_row[col]}")  # デバッグ用
-
-                    if pd.notnull(original_value) and original_value != 0:
-                        previous_value = previous_row[col]
-                        logging.info(f"Updating {col}: {previous_value} -> {original_value} for seccode {seccode}")
-                        group.at[previous_row.name, col] = original_value  # previous_row を更新
-                        is_any_field_updated = True  # いずれかのカラムが更新されたことを記録
-                    else:
-                        logging.info(f"No update for {col}: {previous_value} (Original: {original_value}) for seccode {seccode}")
-
-                # いずれかのカラムが更新された場合のみ、filingdate を更新
-                if is_any_field_updated:
-                    logging.info(f"Updating filingdate: {previous_row['filingdate']} -> {last_row['filingdate']} for seccode {seccode}")
-                    group.at[previous_row.name, 'filingdate'] = last_row['filingdate']
-                    # Div_flag を設定
-                    group.at[previous_row.name, 'div_flag'] = 'Updated'
-                    logging.info(f"div_flag set for seccode {seccode}, row {previous_row.name}")
-
-        # 更新された group を元の df に反映
-        df_sorted.update(group)
+    df = load_stage_input(df, tables['fins_all'], engine, seccodes).reset_index(drop=True)
+
+    if df.empty:
+        logging.warning(f"{tables['fins_all']} table is empty.")
+
+    df_sorted = run_sharded(fold_forecast_revisions, df)
 
     # DataFrameに現在のタイムスタンプを追加
     df_sorted['timestamp'] = datetime.now()
@@ -132,6 +101,7 @@ def load_and_process_data():
         'opprofit',
         'ordprofit',
         'profit',
+        'earningspershare',
         'divannual',
         'fcastnetsales',
         'fcastopprofit',
@@ -151,9 +121,11 @@ def load_and_process_data():
     df_sorted = df_sorted[fins_all_adjusted_columns_order]
 
     # データベースに保存
-    df_sorted.to_sql(tables["fins_all_adjusted"], engine, if_exists='replace', index=False)
+    write_table(df_sorted, tables["fins_all_adjusted"], engine, index_columns=[['seccode', 'filingdate']], seccodes=seccodes)
     logging.info(f"Updated data with flags saved to '{tables['fins_all_adjusted']}'.")
 
+    return df_sorted.reset_index(drop=True)
+
 
 if __name__ == "__main__":
     try:
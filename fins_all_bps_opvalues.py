@@ -2,342 +2,385 @@
 # fins_all_bps_opvalues.py
 
 from sqlalchemy.exc import SQLAlchemyError
+from collections import namedtuple
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import traceback
 import logging
-from db_utils import get_database_engine, get_table_names
+from db_utils import FullRecomputeRequired, get_database_engine, get_table_names, load_stage_input, write_table
+from fins_all_growth import prior_year_values
+from stage_runner import run_sharded
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 理論価値の計算パラメータ
+# operation_value_multiplier: 事業価値の倍率 / ordprofit_ratio: 経常利益を税引後に換算する割合 / roa_cap: ROA の上限
+# equity_ratio_tiers / asset_eval_rates: 自己資本比率の区切りと資産評価率（評価率は区切りより 1 つ多い）
+# leverage_offset / leverage_min / leverage_max: 1 / (自己資本比率 + offset) を [min, max] に収めたものが ROA レバレッジ
+ValuationParams = namedtuple('ValuationParams', [
+    'operation_value_multiplier',
+    'ordprofit_ratio',
+    'roa_cap',
+    'equity_ratio_tiers',
+    'asset_eval_rates',
+    'leverage_offset',
+    'leverage_min',
+    'leverage_max',
+])
+
+DEFAULT_VALUATION_PARAMS = ValuationParams(
+    operation_value_multiplier=150,
+    ordprofit_ratio=0.7,
+    roa_cap=0.3,
+    equity_ratio_tiers=(0.1, 0.33, 0.5, 0.67, 0.8),
+    asset_eval_rates=(0.5, 0.6, 0.65, 0.7, 0.75, 0.8),
+    leverage_offset=0.33,
+    leverage_min=1,
+    leverage_max=1.5,
+)
+
+# 以下の計算関数では、params の各値はスカラー（1 シナリオ）か (シナリオ数, 1) の配列で、結果は (行数,) か (シナリオ数, 行数) になる
+
+def _asset_eval_rate(equityratio, params):
+    # 自己資本比率に応じた資産評価率（NaN は最上位の評価率）
+    return np.select(
+        [equityratio < tier for tier in params.equity_ratio_tiers],
+        list(params.asset_eval_rates[:-1]),
+        default=params.asset_eval_rates[-1]
+    )
+
+def _earnings_per_share_and_roa(ordprofit, profit, eps_divider, roa_divider, params):
+    # 経常利益がゼロ・空欄なら純利益、それ以外は経常利益の ordprofit_ratio 倍を使う。ROA は絶対値を roa_cap で頭打ち
+    use_profit = np.isnan(ordprofit) | (ordprofit == 0)
+    eps = np.where(use_profit, profit / eps_divider, ordprofit * params.ordprofit_ratio / eps_divider)
+    roa = np.where(use_profit, profit / roa_divider, ordprofit * params.ordprofit_ratio / roa_divider)
+    return eps, np.minimum(np.abs(roa), params.roa_cap)
+
+def _round_like_python(values, digits):
+    # 組み込みの round と同じ丸め（np.round は .xx5 の丸めが異なる）。旧実装の行ごとの round(roa, 2) と同じ値にする
+    return np.array([round(float(value), digits) for value in values], dtype=float)
+
+def _positive_part(values):
+    # max(0, x) と同じく NaN は 0 として扱う
+    return np.where(values > 0, values, 0.0)
+
+def _valuation(data, latest_shares, params):
+    # data: 計算対象の行（総資産・発行済株式数が正の行のみ）/ latest_shares: 各行の最新の発行済株式数（配列かスカラー）
+    column = lambda name: data[name].to_numpy(dtype=float)
+    equity = column('equity')
+    totassets = column('totassets')
+    is_fy = (data['quarter'] == "FY").to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        equityratio = equity / totassets
+        assetevalrate = _asset_eval_rate(equityratio, params)
+        bps_eval = equity * assetevalrate / latest_shares
+        roaleverage = np.clip(1 / (equityratio + params.leverage_offset), params.leverage_min, params.leverage_max)
+
+        eps_divider = latest_shares
+        roa_divider = totassets
+        multiplier = params.operation_value_multiplier
+
+        eps, roa = _earnings_per_share_and_roa(column('ordprofit'), column('profit'), eps_divider, roa_divider, params)
+        opvalue = eps * roa * multiplier * roaleverage
+
+        # FY は来期予想、それ以外は今期予想から計算する（もう一方は 0.0）
+        nextyrfcasteps, nextyrfcastroa = _earnings_per_share_and_roa(
+            column('nextyrfcastordprofit'), column('nextyrfcastprofit'), eps_divider, roa_divider, params
+        )
+        fcasteps, fcastroa = _earnings_per_share_and_roa(
+            column('fcastordprofit'), column('fcastprofit'), eps_divider, roa_divider, params
+        )
+        nextyrfcastopvalue = nextyrfcasteps * nextyrfcastroa * multiplier * roaleverage
+        fcastopvalue = fcasteps * fcastroa * multiplier * roaleverage
+
+    fairvalue = bps_eval + _positive_part(opvalue)
+    nextyrfcastfairvalue = bps_eval + _positive_part(nextyrfcastopvalue)
+    fcastfairvalue = bps_eval + _positive_part(fcastopvalue)
+
+    # FY 以外は今期予想の値を来期予想のカラムにも入れる
+    return {
+        'equityratio': equityratio,
+        'assetevalrate': assetevalrate,
+        'bps_eval': bps_eval,
+        'roaleverage': roaleverage,
+        'eps': eps,
+        'roa': roa,
+        'opvalue': opvalue,
+        'fairvalue': fairvalue,
+        'fcasteps': np.where(is_fy, 0.0, fcasteps),
+        'fcastroa': np.where(is_fy, 0.0, fcastroa),
+        'fcastopvalue': np.where(is_fy, 0.0, fcastopvalue),
+        'fcastfairvalue': np.where(is_fy, 0.0, fcastfairvalue),
+        'nextyrfcasteps': np.where(is_fy, nextyrfcasteps, 0.0),
+        'nextyrfcastroa': np.where(is_fy, nextyrfcastroa, 0.0),
+        'nextyrfcastopvalue': np.where(is_fy, nextyrfcastopvalue, fcastopvalue),
+        'nextyrfcastfairvalue': np.where(is_fy, nextyrfcastfairvalue, fcastfairvalue),
+    }
+
+def latest_shares_by_seccode(df):
+    # 各 seccode で、IssuedSharesInclTreasury がゼロや空欄（NaN）以外の行のうち、最も新しい quarterenddate の値
+    with_shares = df[df['issuedsharesincltreasury'] > 0].sort_values(['seccode', 'quarterenddate'])
+    return with_shares.groupby('seccode')['issuedsharesincltreasury'].last()
+
+def _valid_rows(df, latest_shares):
+    # 総資産・発行済株式数がゼロや空欄の行と、最新の発行済株式数が無い行は計算できないので除外
+    valid = (df['totassets'] > 0) & (df['issuedsharesincltreasury'] > 0)
+    if isinstance(latest_shares, pd.Series):
+        valid &= latest_shares.notna()
+    return valid
+
 # 理論価値計算のための関数
-def calculate_operation_values(company_data):
-
-    # IssuedSharesInclTreasury がゼロや空欄（NaN）の行を除外
-    company_data_filtered = company_data.dropna(subset=['issuedsharesincltreasury'])
-    company_data_filtered = company_data_filtered[company_data_filtered['issuedsharesincltreasury'] > 0]
-
-    if company_data_filtered.empty:
-        logging.info(f"No valid shares data for seccode {company_data['seccode'].iloc[0]}. Skipping this company.")
-
-        return []  # 空のリストを返して、その企業の処理をスキップ
-    
-    # quarterenddate を ソート
-    company_data_filtered = company_data_filtered.sort_values(by='quarterenddate')
-
-    # 最も新しい quarterenddate の IssuedSharesInclTreasury を取得
-    latest_shares = company_data_filtered['issuedsharesincltreasury'].iloc[-1]
-
-    results = []
-
-    for i, row in company_data.iterrows():
-        bps = 0.0
-        bps_eval = 0.0
-        opvalue = 0.0
-        fcastopvalue = 0.0
-        nextyrfcastopvalue = 0.0
-        original_divannual_for_chart = 0.0
-        adjusted_divannual_for_chart = 0.0
-        original_fcastdivannual_for_chart = 0.0
-        adjusted_fcastdivannual_for_chart = 0.0
-        equityratio = 0.0
-        assetevalrate = 0.0
-        roaleverage = 0.0
-        eps = 0.0
-        fcasteps = 0.0
-        nextyrfcasteps = 0.0
-        roa = 0.0
-        fcastroa = 0.0
-        nextyrfcastroa = 0.0
-        fairvalue = 0.0
-        fcastfairvalue = 0.0
-        nextyrfcastfairvalue = 0.0
-        
-        try:
-            if row['totassets'] > 0 and row['issuedsharesincltreasury'] > 0:
-                previous_shares = row['issuedsharesincltreasury']
-                original_divannual_for_chart = row['divannual']
-                original_fcastdivannual_for_chart = row['nextyrfcastdivannual']
-
-                adjusted_divannual_for_chart = original_divannual_for_chart
-                if pd.isna(adjusted_divannual_for_chart) or adjusted_divannual_for_chart == 0:
-                    adjusted_divannual_for_chart = row['fcastdivannual']
-
-                if previous_shares > 0 and previous_shares != latest_shares:
-                    adjusted_divannual_for_chart *= (previous_shares / latest_shares)
-
-                adjusted_fcastdivannual_for_chart = original_fcastdivannual_for_chart
-                if pd.isna(adjusted_fcastdivannual_for_chart) or adjusted_fcastdivannual_for_chart == 0:
-                    adjusted_fcastdivannual_for_chart = row['fcastdivannual']
-
-                if previous_shares > 0 and previous_shares != latest_shares:
-                    adjusted_fcastdivannual_for_chart *= (previous_shares / latest_shares)
-
-                equityratio = row['equity'] / row['totassets']
-                if equityratio < 0.1:
-                    assetevalrate = 0.5
-                elif 0.1 <= equityratio < 0.33:
-                    assetevalrate = 0.6
-                elif 0.33 <= equityratio < 0.5:
-                    assetevalrate = 0.65
-                elif 0.5 <= equityratio < 0.67:
-                    assetevalrate = 0.7
-                elif 0.67 <= equityratio < 0.8:
-                    assetevalrate = 0.75
-                else:
-                    assetevalrate = 0.8
-
-                bps_eval = row['equity'] * assetevalrate / latest_shares
-                bps = row['equity'] / latest_shares
-                roaleverage = 1 / (equityratio + 0.33)
-                roaleverage = min(max(roaleverage, 1), 1.5)
-
-                OPERATION_VALUE_MULTIPLIER = 150
-                eps_divider = latest_shares
-                roa_divider = row['totassets']
-
-                if pd.isna(row['ordprofit']) or row['ordprofit'] == 0:
-                    eps = row['profit'] / eps_divider
-                    roa = row['profit'] / roa_divider
-                else:
-                    eps = row['ordprofit'] * 0.7 / eps_divider
-                    roa = row['ordprofit'] * 0.7 / roa_divider
-
-                roa = abs(roa)
-                roa = min(roa, 0.3)
-
-                opvalue = eps * roa * OPERATION_VALUE_MULTIPLIER * roaleverage
-                fairvalue = bps_eval + max(0, opvalue)
-
-                if row['quarter'] == "FY":
-                    if pd.isna(row['nextyrfcastordprofit']) or row['nextyrfcastordprofit'] == 0:
-                        nextyrfcasteps = row['nextyrfcastprofit'] / eps_divider
-                        nextyrfcastroa = row['nextyrfcastprofit'] / roa_divider
-                    else:
-                        nextyrfcasteps = row['nextyrfcastordprofit'] * 0.7 / eps_divider
-                        nextyrfcastroa = row['nextyrfcastordprofit'] * 0.7 / roa_divider
-
-                    nextyrfcastroa = abs(nextyrfcastroa)
-                    nextyrfcastroa = min(nextyrfcastroa, 0.3)
-
-                    nextyrfcastopvalue = nextyrfcasteps * nextyrfcastroa * OPERATION_VALUE_MULTIPLIER * roaleverage
-                    nextyrfcastfairvalue = bps_eval + max(0, nextyrfcastopvalue)
-
-                else:
-                    if pd.isna(row['fcastordprofit']) or row['fcastordprofit'] == 0:
-                        fcasteps = row['fcastprofit'] / eps_divider
-                        fcastroa = row['fcastprofit'] / roa_divider
-                    else:
-                        fcasteps = row['fcastordprofit'] * 0.7 / eps_divider
-                        fcastroa = row['fcastordprofit'] * 0.7 / roa_divider
-
-                    fcastroa = abs(fcastroa)
-                    fcastroa = min(fcastroa, 0.3)
-
-                    fcastopvalue = fcasteps * fcastroa * OPERATION_VALUE_MULTIPLIER * roaleverage
-                    fcastfairvalue = bps_eval + max(0, fcastopvalue)
-
-                    nextyrfcastopvalue = fcastopvalue
-                    nextyrfcastfairvalue = fcastfairvalue
-
-                result_row = {
-                    'timestamp': datetime.now(),
-                    'filingdate': row['filingdate'],
-                    'seccode': row['seccode'],
-                    'companyname': row['companyname'],
-                    'quarter': row['quarter'],
-                    'quarterenddate': row['quarterenddate'],
-                    'bps': bps,
-                    'bps_eval':bps_eval,
-                    'opvalue': opvalue,
-                    'fcastopvalue': fcastopvalue,
-                    'nextyrfcastopvalue': nextyrfcastopvalue,
-                    'original_divannual_for_chart': original_divannual_for_chart,
-                    'adjusted_divannual_for_chart': adjusted_divannual_for_chart,
-                    'original_fcastdivannual_for_chart': original_fcastdivannual_for_chart,
-                    'adjusted_fcastdivannual_for_chart': adjusted_fcastdivannual_for_chart,
-                    'divannual': row['divannual'],  
-                    'fcastdivannual': row['fcastdivannual'],  
-                    'nextyrfcastdivannual': row['nextyrfcastdivannual'],  
-                    'fiscalyearend': row['fiscalyearend'],
-                    'issuedsharesincltreasury': row['issuedsharesincltreasury'],
-                    'latest_shares': latest_shares,
-                    'totassets': row['totassets'],
-                    'equity': row['equity'],
-                    'equityratio': equityratio,
-                    'assetevalrate': assetevalrate,
-                    'roaleverage': roaleverage,
-                    'eps': eps,
-                    'fcasteps': fcasteps,
-                    'nextyrfcasteps': nextyrfcasteps,
-                    'roa': round(roa, 2),
-                    'fcastroa': fcastroa,
-                    'nextyrfcastroa': nextyrfcastroa,
-                    'fairvalue': fairvalue,
-                    'fcastfairvalue': fcastfairvalue,
-                    'nextyrfcastfairvalue': nextyrfcastfairvalue,
-                    'docname': row['docname']
-                }
-                results.append(result_row)
-
-        except Exception as e:
-            logging.warning(f"Error processing row for seccode {row['seccode']} on {row['filingdate']}: {e}")
-            logging.debug(traceback.format_exc())
-
-            continue
-
-    return results
+def calculate_operation_values(company_data, latest_shares=None, params=DEFAULT_VALUATION_PARAMS):
+    # latest_shares: 各行の最新の発行済株式数（latest_shares_by_seccode を行に展開した Series）
+    # 省略した場合は company_data を 1 社分とみなし、最も新しい quarterenddate の発行済株式数を使う
+    if latest_shares is None:
+        # IssuedSharesInclTreasury がゼロや空欄（NaN）の行を除外
+        company_data_filtered = company_data[company_data['issuedsharesincltreasury'] > 0]
+
+        if company_data_filtered.empty:
+            logging.info(f"No valid shares data for seccode {company_data['seccode'].iloc[0]}. Skipping this company.")
+            return pd.DataFrame()  # 空の DataFrame を返して、その企業の処理をスキップ
+
+        # 最も新しい quarterenddate の IssuedSharesInclTreasury を取得
+        latest_shares = company_data_filtered.sort_values(by='quarterenddate')['issuedsharesincltreasury'].iloc[-1]
+
+    valid = _valid_rows(company_data, latest_shares)
+    data = company_data[valid]
+    if isinstance(latest_shares, pd.Series):
+        latest_shares = latest_shares[valid]
+
+    previous_shares = data['issuedsharesincltreasury']
+    share_ratio = previous_shares / latest_shares
+
+    # 配当（ゼロ・空欄なら今期予想）を最新の株式数ベースに調整
+    original_divannual_for_chart = data['divannual']
+    original_fcastdivannual_for_chart = data['nextyrfcastdivannual']
+    adjusted_divannual_for_chart = original_divannual_for_chart.where(
+        original_divannual_for_chart.notna() & (original_divannual_for_chart != 0), data['fcastdivannual']
+    ) * share_ratio
+    adjusted_fcastdivannual_for_chart = original_fcastdivannual_for_chart.where(
+        original_fcastdivannual_for_chart.notna() & (original_fcastdivannual_for_chart != 0), data['fcastdivannual']
+    ) * share_ratio
+
+    latest_shares_values = latest_shares.to_numpy(dtype=float) if isinstance(latest_shares, pd.Series) else latest_shares
+    values = _valuation(data, latest_shares_values, params)
+
+    return pd.DataFrame({
+        'timestamp': datetime.now(),
+        'filingdate': data['filingdate'],
+        'seccode': data['seccode'],
+        'companyname': data['companyname'],
+        'quarter': data['quarter'],
+        'quarterenddate': data['quarterenddate'],
+        'bps': data['equity'] / latest_shares,
+        'bps_eval': values['bps_eval'],
+        'opvalue': values['opvalue'],
+        'fcastopvalue': values['fcastopvalue'],
+        'nextyrfcastopvalue': values['nextyrfcastopvalue'],
+        'original_divannual_for_chart': original_divannual_for_chart,
+        'adjusted_divannual_for_chart': adjusted_divannual_for_chart,
+        'original_fcastdivannual_for_chart': original_fcastdivannual_for_chart,
+        'adjusted_fcastdivannual_for_chart': adjusted_fcastdivannual_for_chart,
+        'divannual': data['divannual'],
+        'fcastdivannual': data['fcastdivannual'],
+        'nextyrfcastdivannual': data['nextyrfcastdivannual'],
+        'fiscalyearend': data['fiscalyearend'],
+        'issuedsharesincltreasury': previous_shares,
+        'latest_shares': latest_shares,
+        'totassets': data['totassets'],
+        'equity': data['equity'],
+        'equityratio': values['equityratio'],
+        'assetevalrate': values['assetevalrate'],
+        'roaleverage': values['roaleverage'],
+        'eps': values['eps'],
+        'fcasteps': values['fcasteps'],
+        'nextyrfcasteps': values['nextyrfcasteps'],
+        'roa': _round_like_python(values['roa'], 2),
+        'fcastroa': values['fcastroa'],
+        'nextyrfcastroa': values['nextyrfcastroa'],
+        'fairvalue': values['fairvalue'],
+        'fcastfairvalue': values['fcastfairvalue'],
+        'nextyrfcastfairvalue': values['nextyrfcastfairvalue'],
+        'docname': data['docname']
+    }, index=data.index)
+
+def _stack_params(scenarios):
+    # シナリオごとの ValuationParams を、各値が (シナリオ数, 1) の配列の ValuationParams にまとめる
+    stacked = {}
+    for field in ValuationParams._fields:
+        values = [getattr(params, field) for params in scenarios]
+        if isinstance(values[0], (tuple, list)):
+            if len({len(value) for value in values}) != 1:
+                raise ValueError(f"All scenarios must have the same number of {field}.")
+            stacked[field] = tuple(np.array(tier, dtype=float)[:, None] for tier in zip(*values))
+        else:
+            stacked[field] = np.array(values, dtype=float)[:, None]
+    return ValuationParams(**stacked)
+
+SCENARIO_VALUE_COLUMNS = [
+    'bps_eval',
+    'opvalue',
+    'fcastopvalue',
+    'nextyrfcastopvalue',
+    'fairvalue',
+    'fcastfairvalue',
+    'nextyrfcastfairvalue',
+]
+
+def evaluate_scenarios(df, scenarios):
+    # 同じ fins_all_adjusted のスナップショットに対して複数のパラメータセットを 1 回のブロードキャスト計算で評価する
+    # scenarios: {シナリオ名: ValuationParams}
+    # 戻り値: (scenario, seccode, 期間) ごとの理論価値（縦持ち）
+    if not scenarios:
+        raise ValueError("At least one scenario must be provided.")
+    names = list(scenarios)
+
+    source_df = df[~df['docname'].isin(['EarnForecastRevision', 'DividendForecastRevision'])]
+    latest_shares = source_df['seccode'].map(latest_shares_by_seccode(source_df))
+    valid = _valid_rows(source_df, latest_shares)
+    data = source_df[valid]
+    logging.info(f"Evaluating {len(names)} valuation scenarios over {len(data)} rows.")
+
+    values = _valuation(data, latest_shares[valid].to_numpy(dtype=float), _stack_params([scenarios[name] for name in names]))
+
+    # (シナリオ数, 行数) の配列を、シナリオ順・行順の縦持ちに展開する
+    id_columns = ['seccode', 'companyname', 'fiscalyearend', 'quarter', 'quarterenddate', 'filingdate', 'docname']
+    result = pd.DataFrame({'scenario': np.repeat(names, len(data))})
+    for col in id_columns:
+        result[col] = np.tile(data[col].to_numpy(), len(names))
+    for col in SCENARIO_VALUE_COLUMNS:
+        result[col] = np.broadcast_to(values[col], (len(names), len(data))).ravel()
+    return result
 
 def calculate_and_add_growth_rates(df):
-    # fiscalyearendのyearを使用して年度ベースで比較する
-    df['fiscalyearend_year'] = df['fiscalyearend'].dt.year
-
     # Sort by SecCode and QuarterEndDate
-    df.sort_values(['seccode', 'quarterenddate'], inplace=True)
-
-    grouped = df.groupby('seccode')
-    logging.info(f"📊 Grouped by seccode. Total unique seccodes: {len(grouped)}")
-
-    for name, group in grouped:
-        logging.info(f"🔁 Processing BPS OpValue for seccode: {name} with {len(group)} rows")
-        for i, row in group.iterrows():
-            growth_amount_opvalue = 0.0
-            growth_percentage_opvalue = 0.0
-            projected_growth_rate_opvalue = 0.0
-
-            # 成長率計算: FY（年度末）の場合
-            if row['quarter'] == 'FY':
-                if pd.notnull(row['nextyrfcastopvalue']) and row['nextyrfcastopvalue'] != 0:
-                    growth_amount_opvalue = row['nextyrfcastopvalue'] - row['opvalue']
-                    if row['opvalue'] != 0:
-                        growth_percentage_opvalue = (growth_amount_opvalue / abs(row['opvalue'])) * 100
-            else:
-                # 前年度の同じ四半期データを検索する
-                previous_fy_row = group[
-                    (group['fiscalyearend_year'] == row['fiscalyearend_year'] - 1) &  # 年度で比較
-                    (group['quarter'] == 'FY')  # 四半期で比較
-                ]
-                if not previous_fy_row.empty:
-                    prev_fy_opvalue = previous_fy_row['opvalue'].values[0]
-                    growth_amount_opvalue = row['fcastopvalue'] - prev_fy_opvalue
-                    if prev_fy_opvalue != 0:
-                        growth_percentage_opvalue = (growth_amount_opvalue / abs(prev_fy_opvalue)) * 100
-
-            # 成長率計算: FYの場合
-            if row['quarter'] == 'FY':
-                if pd.notnull(row['nextyrfcastopvalue']) and row['nextyrfcastopvalue'] != 0:
-                    if row['opvalue'] != 0:
-                        projected_growth_rate_opvalue = ((row['nextyrfcastopvalue'] - row['opvalue']) / abs(row['opvalue'])) * 100
-            else:
-                # 前年度のデータを基に予測成長率を計算する
-                if pd.notnull(row['fcastopvalue']) and row['fcastopvalue'] != 0:
-                    previous_fy_row = group[
-                        (group['fiscalyearend_year'] == row['fiscalyearend_year'] - 1) &  # 年度で比較
-                        (group['quarter'] == 'FY')  # 四半期で比較
-                    ]
-                    if not previous_fy_row.empty:
-                        prev_fy_opvalue = previous_fy_row['opvalue'].values[0]
-                        if prev_fy_opvalue != 0:
-                            projected_growth_rate_opvalue = ((row['fcastopvalue'] - prev_fy_opvalue) / abs(prev_fy_opvalue)) * 100
-
-            # 計算結果をDataFrameに格納
-            df.at[i, 'growth_amount_opvalue'] = growth_amount_opvalue
-            df.at[i, 'growth_percentage_opvalue'] = growth_percentage_opvalue
-            df.at[i, 'projected_growth_rate_opvalue'] = projected_growth_rate_opvalue
+    df = df.sort_values(['seccode', 'quarterenddate'])
+    logging.info(f"📊 Calculating opvalue growth rates. Total unique seccodes: {df['seccode'].nunique()}")
+
+    opvalue = df['opvalue']
+    fcastopvalue = df['fcastopvalue']
+    nextyrfcastopvalue = df['nextyrfcastopvalue']
+    is_fy = df['quarter'] == 'FY'
+
+    # 前年度（fiscalyearend の年 - 1）の FY の opvalue を 1 回の keyed merge で引く
+    previous_fy = prior_year_values(df, ['opvalue'], same_quarter=False)
+    prev_fy_opvalue = previous_fy['opvalue']
+
+    # FY（年度末）: 来期予想 / 当期実績、FY 以外: 今期予想 / 前年度 FY 実績（ゼロ除算は 0.0）
+    fy_amount = nextyrfcastopvalue - opvalue
+    fy_percentage = ((fy_amount / opvalue.abs()) * 100).where(opvalue != 0, 0.0)
+    quarter_amount = fcastopvalue - prev_fy_opvalue
+    quarter_percentage = ((quarter_amount / prev_fy_opvalue.abs()) * 100).where(prev_fy_opvalue != 0, 0.0)
+
+    use_fy = is_fy & nextyrfcastopvalue.notna() & (nextyrfcastopvalue != 0)
+    use_quarter = ~is_fy & previous_fy['found']
+    use_quarter_projection = use_quarter & fcastopvalue.notna() & (fcastopvalue != 0) & (prev_fy_opvalue != 0)
+
+    zeros = pd.Series(0.0, index=df.index)
+    df['growth_amount_opvalue'] = zeros.mask(use_fy, fy_amount).mask(use_quarter, quarter_amount)
+    df['growth_percentage_opvalue'] = zeros.mask(use_fy, fy_percentage).mask(use_quarter, quarter_percentage)
+    df['projected_growth_rate_opvalue'] = (
+        zeros.mask(use_fy & (opvalue != 0), fy_percentage).mask(use_quarter_projection, quarter_percentage)
+    )
 
     return df
 
-def process_and_save_operation_values():
+def compute_operation_values(source_df):
+    # 修正開示を除いた fins_all_adjusted の行から、理論価値と opvalue の成長率を計算する（seccode ごとに閉じた計算）
+    # 各 seccode の最新の発行済株式数を 1 回の groupby で求め、各行に展開する
+    latest_shares = latest_shares_by_seccode(source_df)
+    seccode_count = source_df['seccode'].nunique()
+    logging.info(f"Found {seccode_count} unique seccodes ({seccode_count - len(latest_shares)} without valid shares data skipped).")
+
+    operation_values_df = calculate_operation_values(source_df, source_df['seccode'].map(latest_shares))
+    logging.info(f"Final DataFrame shape before growth calculation: {len(operation_values_df)} rows.")
+    return calculate_and_add_growth_rates(operation_values_df)
+
+def process_and_save_operation_values(df=None, engine=None, seccodes=None):
     logging.info("Connecting to the database...")
 
-    # DBエンジン
-    engine, environment = get_database_engine()
+    # DBエンジン（引数で渡された場合は共有のエンジン／コネクションを使う）
+    if engine is None:
+        engine, environment = get_database_engine()
     tables = get_table_names()
 
     try:
-        with engine.connect() as conn:
-            logging.info(f"Loading data from '{tables['fins_all_adjusted']}'...")  
-            source_df = pd.read_sql_table(tables['fins_all_adjusted'], engine)
-            logging.info(f"Loaded {len(source_df)} rows from '{tables['fins_all_adjusted']}'.")
-
-            # EarnForecastRevision と DividendForecastRevision を削除
-            logging.info("Removing 'EarnForecastRevision' and 'DividendForecastRevision' rows...")
-            source_df_filtered = source_df[~source_df['docname'].isin(['EarnForecastRevision', 'DividendForecastRevision'])]
-            logging.info(f"Remaining rows after filtering: {len(source_df_filtered)}.")
-
-            seccode_list = source_df_filtered['seccode'].unique()
-            logging.info(f"Found {len(seccode_list)} unique seccodes.")
-
-            results = []
-            for seccode in seccode_list:
-                company_data = source_df_filtered[source_df_filtered['seccode'] == seccode]
-                seccode_results = calculate_operation_values(company_data)
-                results.extend(seccode_results)
-
-            # Convert results to DataFrame and calculate growth rates at the same time
-            logging.info(f"Final DataFrame shape before growth calculation: {len(results)} rows.")
-            opvalue_growth_df = calculate_and_add_growth_rates(pd.DataFrame(results))
-
-            # カラム順を指定
-            localserver_u_fins_all_bps_opvalues_columns_order = [
-                'timestamp', 
-                'filingdate', 
-                'seccode', 
-                'companyname', 
-                'quarter', 
-                'quarterenddate', 
-                'bps', 
-                'bps_eval',
-                'opvalue', 
-                'growth_amount_opvalue', 
-                'growth_percentage_opvalue', 
-                'fcastopvalue', 
-                'projected_growth_rate_opvalue', 
-                'nextyrfcastopvalue',
-                'original_divannual_for_chart', 
-                'adjusted_divannual_for_chart',
-                'original_fcastdivannual_for_chart', 
-                'adjusted_fcastdivannual_for_chart',
-                'divannual', 
-                'fcastdivannual', 
-                'nextyrfcastdivannual',
-                'fiscalyearend', 
-                'issuedsharesincltreasury', 
-                'latest_shares',
-                'totassets', 
-                'equity', 
-                'equityratio', 
-                'assetevalrate', 
-                'roaleverage', 
-                'eps', 
-                'fcasteps', 
-                'nextyrfcasteps', 
-                'roa', 
-                'fcastroa', 
-                'nextyrfcastroa', 
-                'fairvalue', 
-                'fcastfairvalue', 
-                'nextyrfcastfairvalue', 
-                'docname'
-            ]
-            
-            # カラム順を再設定
-            #logging.info(f"Reordering columns for the new DataFrame: {opvalue_growth_df.columns}")
-            opvalue_growth_df = opvalue_growth_df[localserver_u_fins_all_bps_opvalues_columns_order]
-
-            # テーブルに保存
-            logging.info(f"Final DataFrame shape after growth calculation: {opvalue_growth_df.shape}.")
-            logging.info(f"Writing to table: {tables['fins_all_bps_opvalues']}")
-            opvalue_growth_df.to_sql(tables['fins_all_bps_opvalues'], conn, if_exists='replace', index=False)
-            logging.info(f"✅Operation values written to '{tables['fins_all_bps_opvalues']}'.")
+        source_df = load_stage_input(df, tables['fins_all_adjusted'], engine, seccodes)
+
+        # EarnForecastRevision と DividendForecastRevision を削除
+        logging.info("Removing 'EarnForecastRevision' and 'DividendForecastRevision' rows...")
+        source_df_filtered = source_df[~source_df['docname'].isin(['EarnForecastRevision', 'DividendForecastRevision'])]
+        logging.info(f"Remaining rows after filtering: {len(source_df_filtered)}.")
+
+        opvalue_growth_df = run_sharded(compute_operation_values, source_df_filtered).reset_index(drop=True)
+
+        # カラム順を指定
+        localserver_u_fins_all_bps_opvalues_columns_order = [
+            'timestamp', 
+            'filingdate', 
+            'seccode', 
+            'companyname', 
+            'quarter', 
+            'quarterenddate', 
+            'bps', 
+            'bps_eval',
+            'opvalue', 
+            'growth_amount_opvalue', 
+            'growth_percentage_opvalue', 
+            'fcastopvalue', 
+            'projected_growth_rate_opvalue', 
+            'nextyrfcastopvalue',
+            'original_divannual_for_chart', 
+            'adjusted_divannual_for_chart',
+            'original_fcastdivannual_for_chart', 
+            'adjusted_fcastdivannual_for_chart',
+            'divannual', 
+            'fcastdivannual', 
+            'nextyrfcastdivannual',
+            'fiscalyearend', 
+            'issuedsharesincltreasury', 
+            'latest_shares',
+            'totassets', 
+            'equity', 
+            'equityratio', 
+            'assetevalrate', 
+            'roaleverage', 
+            'eps', 
+            'fcasteps', 
+            'nextyrfcasteps', 
+            'roa', 
+            'fcastroa', 
+            'nextyrfcastroa', 
+            'fairvalue', 
+            'fcastfairvalue', 
+            'nextyrfcastfairvalue', 
+            'docname'
+        ]
+        
+        # カラム順を再設定
+        #logging.info(f"Reordering columns for the new DataFrame: {opvalue_growth_df.columns}")
+        opvalue_growth_df = opvalue_growth_df[localserver_u_fins_all_bps_opvalues_columns_order]
+
+        # テーブルに保存
+        logging.info(f"Final DataFrame shape after growth calculation: {opvalue_growth_df.shape}.")
+        logging.info(f"Writing to table: {tables['fins_all_bps_opvalues']}")
+        write_table(opvalue_growth_df, tables['fins_all_bps_opvalues'], engine, index_columns=[['seccode', 'quarterenddate']], seccodes=seccodes)
+        logging.info(f"✅Operation values written to '{tables['fins_all_bps_opvalues']}'.")
+        return opvalue_growth_df
 
     except SQLAlchemyError as e:
         logging.error(f"Database error occurred: {e}")
         logging.error(traceback.format_exc())
+        raise
+    except FullRecomputeRequired:
+        raise
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
         logging.error(traceback.format_exc())
+        raise
 
 if __name__ == "__main__":
     logging.info("🚀BPS OpValue Process started...")
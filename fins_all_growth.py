@@ -0,0 +1,152 @@
+# fins_all_growth.py
+
+# 複数の指標（売上・営業利益・経常利益・純利益・EPS）の成長率を 1 パスで計算し、横持ちのテーブルに保存する
+# 計算ルールは fins_all_netsales と同じ:
+# - growth_amount / growth_percentage: 前年度の同じ四半期との比較（見つからなければ 0.0、前年度がゼロなら NaN）
+# - projected_growth_rate: FY は来期予想 / 当期実績、FY 以外は今期予想 / 前年度 FY 実績
+
+import logging
+from datetime import datetime
+from functools import partial
+import pandas as pd
+from db_utils import get_database_engine, get_table_names, load_stage_input, write_table
+from stage_runner import run_sharded
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# metric: 実績カラム / fcast: 今期予想カラム / nextyrfcast: 来期予想カラム
+# 予想が無い指標は None（projected_growth_rate のカラムは作らない。0.0 と書くと「予想成長率 0%」と区別できないため）
+NETSALES_METRIC = {'metric': 'netsales', 'fcast': 'fcastnetsales', 'nextyrfcast': 'nextyrfcastnetsales'}
+
+GROWTH_METRICS = [
+    NETSALES_METRIC,
+    {'metric': 'opprofit', 'fcast': 'fcastopprofit', 'nextyrfcast': 'nextyrfcastopprofit'},
+    {'metric': 'ordprofit', 'fcast': 'fcastordprofit', 'nextyrfcast': 'nextyrfcastordprofit'},
+    {'metric': 'profit', 'fcast': 'fcastprofit', 'nextyrfcast': 'nextyrfcastprofit'},
+    {'metric': 'earningspershare', 'fcast': None, 'nextyrfcast': None},
+]
+
+GROWTH_ID_COLUMNS = [
+    'timestamp',
+    'filingdate',
+    'earn_flag',  # EarnForecastRevision のフラグ
+    'div_flag',   # DividendForecastRevision のフラグ
+    'docname',
+    'seccode',
+    'companyname',
+    'fiscalyearend',
+    'quarter',
+    'quarterenddate',
+]
+
+def period_values(df, value_columns, fiscal_year, quarter):
+    # 各行について、同じ seccode で fiscalyearend の年が fiscal_year、四半期が quarter の最初の行の値を返す
+    # fiscal_year / quarter は行ごとの Series（quarter はスカラーでもよい）。df はソート済みであること
+    # 見つかったかどうかは 'found' カラム
+    keys = ['seccode', 'fiscal_year', 'quarter']
+
+    rows = pd.DataFrame({
+        'seccode': df['seccode'].to_numpy(),
+        'fiscal_year': fiscal_year.to_numpy(),
+        'quarter': quarter.to_numpy() if isinstance(quarter, pd.Series) else quarter,
+    })
+    candidates = df[['seccode', 'quarter'] + value_columns].assign(fiscal_year=df['fiscalyearend'].dt.year)
+    candidates = candidates.dropna(subset=keys).drop_duplicates(subset=keys, keep='first').assign(found=True)
+
+    matched = rows.merge(candidates, on=keys, how='left')
+    matched.index = df.index
+    matched['found'] = matched['found'].eq(True)
+    return matched[value_columns + ['found']]
+
+def prior_year_values(df, value_columns, same_quarter=True):
+    # 前年度（fiscalyearend の年 - 1）の同じ四半期（same_quarter=False なら FY）の値
+    previous_year = df['fiscalyearend'].dt.year - 1
+    return period_values(df, value_columns, previous_year, df['quarter'] if same_quarter else 'FY')
+
+def compute_growth_rates(df, metrics=GROWTH_METRICS):
+    # EarnForecastRevision と DividendForecastRevision を削除
+    df_filtered = df[~df['docname'].isin(['EarnForecastRevision', 'DividendForecastRevision'])].copy()
+    logging.info(f"🧹 Filtered out revision rows. Remaining rows: {len(df_filtered)}")
+
+    # Sort the DataFrame without using inplace
+    df_filtered = df_filtered.sort_values(['seccode', 'quarterenddate'])
+    logging.info(f"📊 Total unique seccodes: {df_filtered['seccode'].nunique()}")
+
+    # 前年度の同じ四半期・前年度 FY の値は、全指標分をまとめて 1 回ずつ引く
+    metric_columns = [m['metric'] for m in metrics]
+    previous_year = prior_year_values(df_filtered, metric_columns)
+    previous_fy = prior_year_values(df_filtered, metric_columns, same_quarter=False)
+    is_fy = df_filtered['quarter'] == 'FY'
+
+    growth_columns = {}
+    for m in metrics:
+        name = m['metric']
+        actual = df_filtered[name]
+
+        # QonQ Growth Calculation
+        prev_actual = previous_year[name]
+        growth_amount = actual - prev_actual
+        growth_percentage = ((growth_amount / prev_actual) * 100).where(prev_actual != 0)
+        growth_columns[f'growth_amount_{name}'] = growth_amount.where(previous_year['found'], 0.0)
+        growth_columns[f'growth_percentage_{name}'] = growth_percentage.where(previous_year['found'], 0.0)
+
+        if not (m['fcast'] or m['nextyrfcast']):
+            continue
+
+        # Projected Growth Rate Calculation
+        projected = pd.Series(0.0, index=df_filtered.index)
+        if m['nextyrfcast']:
+            nextyr_fcast = df_filtered[m['nextyrfcast']]
+            fy_projected = (((nextyr_fcast - actual) / actual) * 100).where(actual != 0, 0.0)
+            use_fy = is_fy & nextyr_fcast.notna() & (nextyr_fcast != 0)
+            projected[use_fy] = fy_projected[use_fy]
+        if m['fcast']:
+            fcast = df_filtered[m['fcast']]
+            prev_fy_actual = previous_fy[name]
+            quarter_projected = (((fcast - prev_fy_actual) / prev_fy_actual) * 100).where(prev_fy_actual != 0)
+            use_quarter = ~is_fy & fcast.notna() & (fcast != 0) & previous_fy['found']
+            projected[use_quarter] = quarter_projected[use_quarter]
+        growth_columns[f'projected_growth_rate_{name}'] = projected
+
+    return pd.concat([df_filtered, pd.DataFrame(growth_columns, index=df_filtered.index)], axis=1)
+
+def growth_columns_order(metrics=GROWTH_METRICS):
+    columns = list(GROWTH_ID_COLUMNS)
+    for m in metrics:
+        name = m['metric']
+        columns += [name, f'growth_amount_{name}', f'growth_percentage_{name}']
+        if m['fcast'] or m['nextyrfcast']:
+            columns += [f'projected_growth_rate_{name}']
+        columns += [col for col in (m['fcast'], m['nextyrfcast']) if col]
+    return columns
+
+def calculate_and_save_metric_growth_rates(df=None, engine=None, metrics=GROWTH_METRICS, seccodes=None):
+    # DBエンジン（引数で渡された場合は共有のエンジン／コネクションを使う）
+    if engine is None:
+        engine, environment = get_database_engine()
+    tables = get_table_names()
+
+    df = load_stage_input(df, tables['fins_all_adjusted'], engine, seccodes)
+
+    logging.info(f"📈 Calculating growth rates for: {', '.join(m['metric'] for m in metrics)}")
+    df_growth = run_sharded(partial(compute_growth_rates, metrics=metrics), df)
+
+    # DataFrameに現在のタイムスタンプを追加
+    df_growth['timestamp'] = datetime.now()
+    growth_df = df_growth[growth_columns_order(metrics)]
+
+    logging.info(f"Saving {len(growth_df)} rows to the {tables['fins_all_growth']} table...")
+    write_table(growth_df, tables['fins_all_growth'], engine, index_columns=[['seccode', 'quarterenddate']], seccodes=seccodes)
+    logging.info(f"✅ Growth data saved to the {tables['fins_all_growth']} table.")
+
+    return growth_df
+
+if __name__ == "__main__":
+    logging.info("🚀 Starting the script 'Growth'...")
+    try:
+        calculate_and_save_metric_growth_rates()
+    except Exception as e:
+        logging.error(f"❌ An error occurred: {e}")
+
+    logging.info("✅ 'Growth' rates calculated and saved.")
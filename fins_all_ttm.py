@@ -0,0 +1,101 @@
+# fins_all_ttm.py
+
+# J-Quants の 1Q / 2Q / 3Q / FY は期首からの累計値なので、四半期単独の値と直近 12 か月（TTM）の値に変換して保存する
+# - standalone_*: 1Q はそのまま、2Q / 3Q / FY は同じ年度の直前の四半期の累計値を引いたもの
+# - ttm_*: FY はそのまま、それ以外は 当期累計 + 前年度 FY - 前年度の同じ四半期の累計
+# 必要な行が見つからない場合は NaN
+
+import logging
+from datetime import datetime
+import pandas as pd
+from db_utils import get_database_engine, get_table_names, load_stage_input, write_table
+from fins_all_growth import period_values, prior_year_values
+from stage_runner import run_sharded
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 累計値で開示される損益計算書のカラム
+PL_COLUMNS = ['netsales', 'opprofit', 'ordprofit', 'profit']
+
+# 各四半期の直前の四半期（1Q は期首なので無し）
+PREVIOUS_QUARTER = {'2': '1', '3': '2', 'FY': '3'}
+
+TTM_ID_COLUMNS = [
+    'timestamp',
+    'filingdate',
+    'docname',
+    'seccode',
+    'companyname',
+    'fiscalyearend',
+    'quarter',
+    'quarterenddate',
+]
+
+def compute_ttm_values(df, value_columns=PL_COLUMNS):
+    # EarnForecastRevision と DividendForecastRevision を削除
+    df_filtered = df[~df['docname'].isin(['EarnForecastRevision', 'DividendForecastRevision'])].copy()
+    logging.info(f"🧹 Filtered out revision rows. Remaining rows: {len(df_filtered)}")
+
+    df_filtered = df_filtered.sort_values(['seccode', 'quarterenddate'])
+    logging.info(f"📊 Total unique seccodes: {df_filtered['seccode'].nunique()}")
+
+    # 同じ年度の直前の四半期・前年度の同じ四半期・前年度 FY の累計値を、全カラム分まとめて 1 回ずつ引く
+    fiscal_year = df_filtered['fiscalyearend'].dt.year
+    quarter = df_filtered['quarter']
+    previous_quarter = period_values(df_filtered, value_columns, fiscal_year, quarter.map(PREVIOUS_QUARTER))
+    previous_year = prior_year_values(df_filtered, value_columns)
+    previous_fy = prior_year_values(df_filtered, value_columns, same_quarter=False)
+
+    is_first = quarter == '1'
+    is_fy = quarter == 'FY'
+    has_previous_quarter = previous_quarter['found']
+    has_previous_year = previous_year['found'] & previous_fy['found']
+
+    derived_columns = {}
+    for col in value_columns:
+        cumulative = df_filtered[col]
+
+        standalone = (cumulative - previous_quarter[col]).where(has_previous_quarter)
+        derived_columns[f'standalone_{col}'] = standalone.mask(is_first, cumulative)
+
+        ttm = (cumulative + previous_fy[col] - previous_year[col]).where(has_previous_year)
+        derived_columns[f'ttm_{col}'] = ttm.mask(is_fy, cumulative)
+
+    return pd.concat([df_filtered, pd.DataFrame(derived_columns, index=df_filtered.index)], axis=1)
+
+def ttm_columns_order(value_columns=PL_COLUMNS):
+    columns = list(TTM_ID_COLUMNS)
+    for col in value_columns:
+        columns += [col, f'standalone_{col}', f'ttm_{col}']
+    return columns
+
+def calculate_and_save_ttm_values(df=None, engine=None, seccodes=None):
+    # DBエンジン（引数で渡された場合は共有のエンジン／コネクションを使う）
+    if engine is None:
+        engine, environment = get_database_engine()
+    tables = get_table_names()
+
+    df = load_stage_input(df, tables['fins_all_adjusted'], engine, seccodes)
+
+    logging.info(f"🧮 Calculating standalone-quarter and TTM values for: {', '.join(PL_COLUMNS)}")
+    df_ttm = run_sharded(compute_ttm_values, df)
+
+    # DataFrameに現在のタイムスタンプを追加
+    df_ttm['timestamp'] = datetime.now()
+    ttm_df = df_ttm[ttm_columns_order()]
+
+    logging.info(f"Saving {len(ttm_df)} rows to the {tables['fins_all_ttm']} table...")
+    write_table(ttm_df, tables['fins_all_ttm'], engine, index_columns=[['seccode', 'quarterenddate']], seccodes=seccodes)
+    logging.info(f"✅ TTM data saved to the {tables['fins_all_ttm']} table.")
+
+    return ttm_df
+
+if __name__ == "__main__":
+    logging.info("🚀 Starting the script 'TTM'...")
+    try:
+        calculate_and_save_ttm_values()
+    except Exception as e:
+        logging.error(f"❌ An error occurred: {e}")
+
+    logging.info("✅ 'TTM' values calculated and saved.")
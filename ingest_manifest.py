@@ -0,0 +1,81 @@
+# ingest_manifest.py
+
+# 取り込み済み JSON ファイルの記録（マニフェスト）
+# S3 は ETag、ローカルは mtime（ナノ秒）とサイズをシグネチャとして保存し、
+# 次回以降は新規・変更されたファイルだけをパースする
+# 銘柄一覧に無い企業の開示を含むファイルは「シグネチャ|銘柄一覧のバージョン」で記録し、銘柄一覧が変わったら読み直す
+
+import os
+import hashlib
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text
+from db_utils import transaction
+
+def local_file_signature(file_path):
+    # 秒単位だと同じ秒内に同じサイズで書き直されたファイルを見逃すので、ナノ秒の mtime を使う
+    stat = os.stat(file_path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+def company_list_version(company_dict):
+    # 銘柄一覧（コードの集合）のハッシュ
+    return hashlib.sha1(",".join(sorted(company_dict)).encode("utf-8")).hexdigest()[:12]
+
+def tag_unresolved_files(files, unresolved_keys, company_version):
+    # 銘柄一覧に無い企業の開示を含むファイルのシグネチャに、銘柄一覧のバージョンを付ける
+    return [
+        (filekey, f"{signature}|{company_version}" if filekey in unresolved_keys else signature)
+        for filekey, signature in files
+    ]
+
+def load_manifest(engine, tables, source):
+    table = tables['fins_all_manifest']
+    if not inspect(engine).has_table(table):
+        logging.info(f"Manifest table '{table}' not found. A full load will be performed.")
+        return {}
+
+    with transaction(engine) as conn:
+        rows = conn.execute(
+            text(f"SELECT filekey, signature FROM {table} WHERE source = :source"),
+            {"source": source}
+        ).fetchall()
+    logging.info(f"📒 Loaded {len(rows)} manifest entries for {source}.")
+    return {filekey: signature for filekey, signature in rows}
+
+def filter_new_files(files, manifest, company_version=None):
+    # files: [(filekey, signature), ...] の順序を保ったまま、新規・変更分だけを返す
+    # 銘柄一覧のバージョン付きで記録されたファイルは、銘柄一覧が同じ（company_version が一致する）間は読み直さない
+    return [
+        (filekey, signature) for filekey, signature in files
+        if manifest.get(filekey) not in (signature, f"{signature}|{company_version}")
+    ]
+
+def save_manifest(engine, tables, source, files, replace=False):
+    table = tables['fins_all_manifest']
+    now = datetime.now()
+    with transaction(engine) as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                source TEXT NOT NULL,
+                filekey TEXT NOT NULL,
+                signature TEXT,
+                ingested_at TIMESTAMP,
+                PRIMARY KEY (source, filekey)
+            )
+        """))
+        if replace:
+            conn.execute(text(f"DELETE FROM {table} WHERE source = :source"), {"source": source})
+        if files:
+            conn.execute(
+                text(f"""
+                    INSERT INTO {table} (source, filekey, signature, ingested_at)
+                    VALUES (:source, :filekey, :signature, :ingested_at)
+                    ON CONFLICT (source, filekey)
+                    DO UPDATE SET signature = EXCLUDED.signature, ingested_at = EXCLUDED.ingested_at
+                """),
+                [
+                    {"source": source, "filekey": filekey, "signature": signature, "ingested_at": now}
+                    for filekey, signature in files
+                ]
+            )
+    logging.info(f"📒 Recorded {len(files)} files in manifest '{table}'.")
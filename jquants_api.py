@@ -4,95 +4,223 @@ import os
 import requests
 import json
 import logging
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
 
+#  Options for overriding defaults:
+# - JQUANTS_TIMEOUT: defaults to "30" seconds per request (connect and read)
+# - JQUANTS_MAX_RETRIES: defaults to "3" attempts per request
+# - JQUANTS_BACKOFF_BASE: defaults to "1" second. The n-th retry waits a random time up to base * 2^n (capped by JQUANTS_BACKOFF_MAX)
+# - JQUANTS_BACKOFF_MAX: defaults to "60" seconds. Caps the client's own backoff only; a server's Retry-After is always honoured
+# - JQUANTS_POOL_SIZE: defaults to "10" keep-alive connections
+# - JQUANTS_BASE_URL: defaults to "https://api.jquants.com/v1" (point it at a local mock server for testing)
+# - JQUANTS_REQUESTS_PER_MINUTE: defaults to "60". Client-side rate limit shared by all threads; set it to your plan's limit
+# - JQUANTS_RATE_BURST: defaults to "5" requests that may be sent back-to-back before the rate limit applies
+# - JQUANTS_MAX_WORKERS: defaults to "4" concurrent requests in fetch_many
+
+# リトライする HTTP ステータス（レート制限とサーバー側のエラー）
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    # rate 件/秒で補充され、最大 capacity 件まで貯まるトークンバケット。acquire はトークンが取れるまで待つ（スレッドセーフ）
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 class JQuantsAPI:
-    def __init__(self, email, password):
+    def __init__(self, email, password, timeout=None, retries=None, session=None, base_url=None, rate_limiter=None):
         self.email = email
         self.password = password
         self.id_token = None
         self.refresh_token = None
+        self.timeout = timeout if timeout is not None else float(os.getenv("JQUANTS_TIMEOUT", "30"))
+        self.retries = retries if retries is not None else int(os.getenv("JQUANTS_MAX_RETRIES", "3"))
+        self.backoff_base = float(os.getenv("JQUANTS_BACKOFF_BASE", "1"))
+        self.backoff_max = float(os.getenv("JQUANTS_BACKOFF_MAX", "60"))
+        self.base_url = (base_url or os.getenv("JQUANTS_BASE_URL", "https://api.jquants.com/v1")).rstrip("/")
+        # 1 つのセッションを使い回し、TCP / TLS のコネクションを keep-alive で再利用する
+        self.session = session or self._create_session()
+        # すべてのリクエスト（リトライ・ページングを含む）が通るクライアント側のレート制限
+        self.rate_limiter = rate_limiter or TokenBucket(
+            rate=float(os.getenv("JQUANTS_REQUESTS_PER_MINUTE", "60")) / 60,
+            capacity=float(os.getenv("JQUANTS_RATE_BURST", "5"))
+        )
+        # ID トークンが拒否された（401）ときに呼ばれる再認証のコールバック（jquants_cache.authenticate が設定する）
+        self.on_unauthorized = None
+        self._auth_lock = threading.Lock()
 
-    def get_refresh_token(self, retries=3):
-        logging.info("Getting refresh token...")
-        data = {"mailaddress": self.email, "password": self.password}
+    def _create_session(self):
+        pool_size = int(os.getenv("JQUANTS_POOL_SIZE", "10"))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def _backoff_delay(self, attempt, response=None):
+        # Retry-After（秒数または HTTP 日付）があればそのまま従い（backoff_max で切り詰めない）、無ければ上限付きの指数バックオフ（full jitter）
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                try:
+                    delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                    return max(delay, 0.0)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _request(self, method, url, description, retries=None, authorized=False, **kwargs):
+        # authorized=True の場合は ID トークンの Authorization ヘッダーを付ける
+        # 401 が返り on_unauthorized が設定されていれば、再認証して 1 回だけ送り直す
+        if not authorized:
+            return self._send(method, url, description, retries, **kwargs)
+        headers = kwargs.pop("headers", {})
+        token = self.id_token
+        try:
+            return self._send(method, url, description, retries,
+                              headers={**headers, 'Authorization': f'Bearer {token}'}, **kwargs)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 401 or self.on_unauthorized is None:
+                raise
+            with self._auth_lock:
+                # 他のスレッドが既に再認証していれば、そのトークンを使う
+                if self.id_token == token:
+                    logging.warning("ID token was rejected (401). Re-authenticating...")
+                    self.on_unauthorized()
+            return self._send(method, url, description, retries,
+                              headers={**headers, 'Authorization': f'Bearer {self.id_token}'}, **kwargs)
+
+    def _send(self, method, url, description, retries=None, **kwargs):
+        # 429 / 5xx / 接続エラー / タイムアウトはバックオフしてリトライ。それ以外の HTTP エラーはすぐに送出する
+        retries = retries if retries is not None else self.retries
+        if retries < 1:
+            raise ValueError(f"retries must be at least 1 (got {retries}).")
         for attempt in range(retries):
+            response = None
+            self.rate_limiter.acquire()
             try:
-                response = requests.post("https://api.jquants.com/v1/token/auth_user", data=json.dumps(data))
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
                 logging.info(f"API Response Status Code: {response.status_code}")
+                if response.status_code in RETRY_STATUS_CODES and attempt < retries - 1:
+                    delay = self._backoff_delay(attempt, response)
+                    logging.warning(f"Failed to {description} with status {response.status_code} "
+                                    f"(attempt {attempt + 1}/{retries}). Retrying in {delay:.1f}s...")
+                    time.sleep(delay)
+                    continue
                 response.raise_for_status()
-                response_data = response.json()
-                
-                self.refresh_token = response_data.get("refreshToken")
-                return self.refresh_token
-            except (HTTPError, ConnectionError, Timeout, RequestException) as e:
-                logging.error(f"Failed to get refresh token (attempt {attempt + 1}/{retries}): {e}")
-                if response.content:
-                    logging.error(f"API Error Message: {response.content.decode('utf-8')}")
+                return response
+            except (ConnectionError, Timeout) as e:
+                logging.error(f"Failed to {description} (attempt {attempt + 1}/{retries}): {e}")
                 if attempt < retries - 1:
-                    time.sleep(5)  # wait before retrying
+                    time.sleep(self._backoff_delay(attempt))
                 else:
                     raise
+            except (HTTPError, RequestException) as e:
+                logging.error(f"Failed to {description} (attempt {attempt + 1}/{retries}): {e}")
+                if response is not None and response.content:
+                    logging.error(f"API Error Message: {response.content.decode('utf-8')}")
+                raise
+
+    def get_refresh_token(self, retries=None):
+        logging.info("Getting refresh token...")
+        data = {"mailaddress": self.email, "password": self.password}
+        response = self._request("POST", f"{self.base_url}/token/auth_user", "get refresh token",
+                                 retries=retries, data=json.dumps(data))
+        self.refresh_token = response.json().get("refreshToken")
         return self.refresh_token
 
-    def get_id_token(self, retries=3):
+    def get_id_token(self, retries=None):
         logging.info("Getting ID token...")
-        for attempt in range(retries):
-            try:
-                response = requests.post(f"https://api.jquants.com/v1/token/auth_refresh?refreshtoken={self.refresh_token}")
-                logging.info(f"API Response Status Code: {response.status_code}")
-                response.raise_for_status()
-                response_data = response.json()
-                
-                self.id_token = response_data.get("idToken")
-                return self.id_token
-            except (HTTPError, ConnectionError, Timeout, RequestException) as e:
-                logging.error(f"Failed to get ID token (attempt {attempt + 1}/{retries}): {e}")
-                if response.content:
-                    logging.error(f"API Error Message: {response.content.decode('utf-8')}")
-                if attempt < retries - 1:
-                    time.sleep(5)  # wait before retrying
-                else:
-                    raise
+        response = self._request("POST", f"{self.base_url}/token/auth_refresh?refreshtoken={self.refresh_token}",
+                                 "get ID token", retries=retries)
+        self.id_token = response.json().get("idToken")
         return self.id_token
 
     def fetch_company_info(self):
+        info, _, _ = self.fetch_company_info_if_changed()
+        return info
+
+    def fetch_company_info_if_changed(self, etag=None, last_modified=None):
+        # 前回の ETag / Last-Modified を付けて取得する。戻り値は (info, ETag, Last-Modified)。変更が無ければ（304）info は None
         logging.info("Fetching company info...")
-        headers = {'Authorization': f'Bearer {self.id_token}'}
-        url = "https://api.jquants.com/v1/listed/info"
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            return response.json().get("info", [])
-        except (HTTPError, ConnectionError, Timeout, RequestException) as e:
-            logging.error(f"Failed to fetch company info: {e}")
-            raise
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        url = f"{self.base_url}/listed/info"
+        response = self._request("GET", url, "fetch company info", authorized=True, headers=headers)
+        if response.status_code == 304:
+            return None, etag, last_modified
+        return response.json().get("info", []), response.headers.get("ETag"), response.headers.get("Last-Modified")
 
-    def fetch_data(self, code=None, date=None):
+    def iter_pages(self, code=None, date=None):
+        # /fins/statements をページ単位で取得し、各ページの statements を到着順に yield する
+        # レスポンスの JSON は 1 ページにつき 1 回だけデコードする
         if not code and not date:
             raise ValueError("Either code or date must be provided.")
 
-        headers = {'Authorization': f'Bearer {self.id_token}'}
-        base_url = "https://api.jquants.com/v1/fins/statements?"
-        url = base_url + (f"code={code}" if code else "") + (f"&date={date}" if date else "")
+        url = f"{self.base_url}/fins/statements"
+        params = {key: value for key, value in (("code", code), ("date", date)) if value}
 
-        logging.info(f"Fetching data from {url}...")
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json().get("statements", [])
+        logging.info(f"Fetching data from {url} with {params}...")
+        while True:
+            body = self._request("GET", url, "fetch data", authorized=True, params=params).json()
+            yield body.get("statements", [])
 
             # Handle pagination
-            while "pagination_key" in response.json():
-                pagination_key = response.json()["pagination_key"]
-                paginated_url = f"{base_url}pagination_key={pagination_key}" + (f"&code={code}" if code else "") + (f"&date={date}" if date else "")
-                logging.info(f"Fetching more data with pagination_key: {pagination_key}...")
-                response = requests.get(paginated_url, headers=headers)
-                response.raise_for_status()
-                data += response.json().get("statements", [])
-        except (HTTPError, ConnectionError, Timeout, RequestException) as e:
-            logging.error(f"Failed to fetch data: {e}")
-            raise
+            pagination_key = body.get("pagination_key")
+            if not pagination_key:
+                break
+            logging.info(f"Fetching more data with pagination_key: {pagination_key}...")
+            params = {**params, "pagination_key": pagination_key}
+
+    def iter_statements(self, code=None, date=None):
+        # 全ページを溜め込まずに statements を 1 件ずつ yield する（fins_all.project_statements などにそのまま渡せる）
+        for statements in self.iter_pages(code=code, date=date):
+            yield from statements
+
+    def fetch_data(self, code=None, date=None):
+        return {"statements": list(self.iter_statements(code=code, date=date))}
+
+    def fetch_many(self, codes=None, dates=None, max_workers=None):
+        # 複数の code（または date）の statements をスレッドプールで並行に取得し、引数の順に連結して返す
+        # 同時実行数に関係なく、リクエストの頻度は rate_limiter で制限される
+        if bool(codes) == bool(dates):
+            raise ValueError("Provide either codes or dates.")
+        if max_workers is None:
+            max_workers = int(os.getenv("JQUANTS_MAX_WORKERS", "4"))
+        requests_args = [{"code": code} for code in codes] if codes else [{"date": date} for date in dates]
 
-        return {"statements": data}
+        logging.info(f"Fetching statements for {len(requests_args)} {'codes' if codes else 'dates'} with {max_workers} workers...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(lambda kwargs: self.fetch_data(**kwargs)["statements"], requests_args)
+            statements = [statement for page in results for statement in page]
+        logging.info(f"Fetched {len(statements)} statements.")
+        return {"statements": statements}
@@ -0,0 +1,127 @@
+# jquants_cache.py
+
+# J-Quants のトークンと上場銘柄一覧（/listed/info）をローカルにキャッシュする
+# - リフレッシュトークン（有効期限 約 1 週間）と ID トークン（約 24 時間）は期限内ならそのまま使う
+# - キャッシュの ID トークンが API に拒否された（401）場合は、キャッシュから削除して認証し直す
+# - 銘柄一覧は TTL 内ならキャッシュを使い、期限切れなら ETag / Last-Modified 付きで取り直す
+# - API が使えない場合は、期限切れのキャッシュでも使って処理を続ける（company_dict が空になるのを防ぐ）
+
+#  Options for overriding defaults:
+# - JQUANTS_CACHE_DIR: defaults to "~/.cache/jquants"
+# - JQUANTS_COMPANY_INFO_TTL_HOURS: defaults to "24"
+
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+TOKENS_FILE = "tokens.json"
+COMPANY_INFO_FILE = "company_info.json"
+
+# 期限切れ直前のトークンを使わないよう、実際の有効期限より短くする
+REFRESH_TOKEN_TTL = timedelta(days=6)
+ID_TOKEN_TTL = timedelta(hours=23)
+
+def _cache_path(name):
+    return os.path.join(os.path.expanduser(os.getenv("JQUANTS_CACHE_DIR", "~/.cache/jquants")), name)
+
+def _read_cache(name):
+    path = _cache_path(name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cache file '{path}': {e}")
+        return None
+
+def _write_cache(name, data):
+    # 一時ファイルに書いてからリネームする。トークンを含むので所有者だけが読めるようにする
+    path = _cache_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _is_fresh(saved_at, ttl):
+    if not saved_at:
+        return False
+    try:
+        return datetime.now() - datetime.fromisoformat(saved_at) < ttl
+    except ValueError:
+        return False
+
+def authenticate(api):
+    # キャッシュの ID トークン → キャッシュのリフレッシュトークンで ID トークンを取得 → メールアドレスとパスワードで認証、の順に試す
+    api.on_unauthorized = lambda: _reauthenticate(api)
+    cache = _read_cache(TOKENS_FILE) or {}
+    if cache.get("id_token") and _is_fresh(cache.get("id_token_at"), ID_TOKEN_TTL):
+        api.refresh_token = cache.get("refresh_token")
+        api.id_token = cache["id_token"]
+        logging.info(f"🔑 Using cached ID token from {cache['id_token_at']}.")
+        return
+
+    now = datetime.now().isoformat()
+    if cache.get("refresh_token") and _is_fresh(cache.get("refresh_token_at"), REFRESH_TOKEN_TTL):
+        api.refresh_token = cache["refresh_token"]
+        try:
+            if api.get_id_token():
+                _write_cache(TOKENS_FILE, {**cache, "id_token": api.id_token, "id_token_at": now})
+                return
+        except Exception as e:
+            logging.warning(f"Cached refresh token was rejected: {e}. Authenticating again...")
+
+    api.get_refresh_token()
+    api.get_id_token()
+    if not api.id_token:
+        raise ValueError("No ID token returned by the API.")
+    _write_cache(TOKENS_FILE, {
+        "refresh_token": api.refresh_token,
+        "refresh_token_at": now,
+        "id_token": api.id_token,
+        "id_token_at": now,
+    })
+
+def _reauthenticate(api):
+    # 拒否された ID トークン（失効・パスワード変更など）をキャッシュから削除し、リフレッシュトークン → パスワードの順で認証し直す
+    cache = _read_cache(TOKENS_FILE) or {}
+    cache.pop("id_token", None)
+    cache.pop("id_token_at", None)
+    _write_cache(TOKENS_FILE, cache)
+    authenticate(api)
+
+def load_company_info(api, authenticated=True):
+    # TTL 内のキャッシュがあればそのまま返す。期限切れなら条件付きで取得し、失敗した場合は古いキャッシュを返す
+    cache = _read_cache(COMPANY_INFO_FILE)
+    ttl = timedelta(hours=float(os.getenv("JQUANTS_COMPANY_INFO_TTL_HOURS", "24")))
+    if cache and _is_fresh(cache.get("fetched_at"), ttl):
+        logging.info(f"🏢 Using cached company info from {cache['fetched_at']} ({len(cache['info'])} companies).")
+        return cache["info"]
+
+    if authenticated:
+        try:
+            info, etag, last_modified = api.fetch_company_info_if_changed(
+                etag=cache.get("etag") if cache else None,
+                last_modified=cache.get("last_modified") if cache else None
+            )
+            if info is None:
+                logging.info("🏢 Company info not modified since the cached copy.")
+                info = cache["info"]
+            _write_cache(COMPANY_INFO_FILE, {
+                "fetched_at": datetime.now().isoformat(),
+                "etag": etag,
+                "last_modified": last_modified,
+                "info": info,
+            })
+            return info
+        except Exception as e:
+            if not cache:
+                raise
+            logging.warning(f"Failed to refresh company info: {e}")
+    elif not cache:
+        raise ValueError("Not authenticated and no cached company info is available.")
+
+    logging.warning(f"⚠️ Using stale cached company info from {cache['fetched_at']} ({len(cache['info'])} companies).")
+    return cache["info"]
@@ -0,0 +1,131 @@
+# stage_runner.py
+
+# パイプラインのステージを依存関係（DAG）に従って実行する
+# 依存先がすべて完了したステージから順に実行する。独立したステージが 2 つ以上同時に実行可能なときだけプロセスプールで並列に実行し、
+# 1 つだけのときは（DataFrame を子プロセスに pickle せず、共有のエンジンを使えるように）このプロセスで実行する
+# ステージ内の seccode ごとの計算は run_sharded で seccode 単位のシャードに分けて並列に実行できる
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from db_utils import FullRecomputeRequired, dispose_engines
+
+# name: ステージ名 / func: 依存先の出力を位置引数で受け取る関数 / depends_on: 依存するステージ名のリスト
+Stage = namedtuple('Stage', ['name', 'func', 'depends_on'])
+
+def _run_stage(func, inputs, kwargs):
+    return func(*inputs, **kwargs)
+
+def run_scoped(func, df=None, engine=None, seccodes=None):
+    # seccodes の範囲だけを再計算するステージの実行。テーブルが無い・カラムが変わったために seccode 単位で書き込めない場合は、
+    # そのステージだけ入力テーブル全体から再計算する（後続のステージに渡す出力は seccodes の範囲に絞る）
+    try:
+        return func(df, engine=engine, seccodes=seccodes)
+    except FullRecomputeRequired as e:
+        logging.warning(f"{e} Recomputing {getattr(func, '__name__', 'stage')} for all seccodes...")
+        result = func(engine=engine)
+        if result is None:
+            return None
+        return result[result['seccode'].isin(seccodes)].reset_index(drop=True)
+
+def _validate(stages, initial_results):
+    names = [stage.name for stage in stages]
+    if len(names) != len(set(names)):
+        raise ValueError(f"Duplicate stage names: {names}")
+    known = set(names) | set(initial_results)
+    for stage in stages:
+        missing = [dep for dep in stage.depends_on if dep not in known]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages: {missing}")
+
+def run_stages(stages, initial_results=None, max_workers=1, stage_kwargs=None, local_kwargs=None):
+    # initial_results: ステージ以外から与える入力（例: {'fins_all': fins_df}）
+    # stage_kwargs: 全ステージに渡すキーワード引数
+    # local_kwargs: このプロセスで実行するステージにだけ追加で渡すキーワード引数（engine などプロセスをまたげないもの）
+    # 戻り値: (results, failed) — 完了したステージの出力と、失敗またはスキップしたステージ名の集合
+    results = dict(initial_results or {})
+    stage_kwargs = stage_kwargs or {}
+    local_kwargs = {**stage_kwargs, **(local_kwargs or {})}
+    _validate(stages, results)
+
+    pending = list(stages)
+    failed = set()
+    running = {}
+
+    def ready_stages():
+        ready = []
+        for stage in list(pending):
+            failed_deps = [dep for dep in stage.depends_on if dep in failed]
+            if failed_deps:
+                logging.error(f"⏭️ Skipping {stage.name} because {', '.join(failed_deps)} failed.")
+                failed.add(stage.name)
+                pending.remove(stage)
+            elif all(dep in results for dep in stage.depends_on):
+                ready.append(stage)
+                pending.remove(stage)
+        return ready
+
+    def finish(stage, run):
+        try:
+            results[stage.name] = run()
+            logging.info(f"{stage.name} completed successfully.")
+        except Exception as e:
+            logging.error(f"Error in {stage.name}: {e}")
+            failed.add(stage.name)
+
+    # プロセスプールは、独立したステージが 2 つ以上同時に実行可能になったときに初めて作る
+    executor = None
+    try:
+        while pending or running:
+            ready = ready_stages()
+            if max_workers <= 1 or (len(ready) == 1 and not running):
+                for stage in ready:
+                    inputs = [results[dep] for dep in stage.depends_on]
+                    finish(stage, lambda: _run_stage(stage.func, inputs, local_kwargs))
+                if ready:
+                    continue
+            else:
+                if ready and executor is None:
+                    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=dispose_engines)
+                for stage in ready:
+                    inputs = [results[dep] for dep in stage.depends_on]
+                    logging.info(f"🚚 Submitting stage {stage.name}...")
+                    running[executor.submit(_run_stage, stage.func, inputs, stage_kwargs)] = stage
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), future.result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return results, failed
+
+def shard_by_seccode(df, shard_count):
+    # 一意の seccode を昇順に並べて連続した範囲で shard_count 個に分ける（同じ seccode の行は必ず同じシャード）
+    # seccode が空欄の行は、ソート順で最後に来るので最後のシャードに入れる
+    seccodes = np.sort(df['seccode'].dropna().unique())
+    parts = [part for part in np.array_split(seccodes, shard_count) if len(part)]
+    shards = [df[df['seccode'].isin(part)] for part in parts]
+    shards[-1] = pd.concat([shards[-1], df[df['seccode'].isna()]])
+    return shards
+
+def run_sharded(func, df, max_workers=None):
+    # func(df) を seccode のシャードごとにプロセスプールで実行し、シャード順に連結して返す
+    # max_workers を省略すると SHARD_MAX_WORKERS（デフォルト 1）。1 以下なら func(df) をそのまま直列に実行する
+    # func は seccode ごとに閉じた計算で、結果を seccode 順に並べるもの（直列実行と同じ結果になる）
+    # プロセス間では各シャードの DataFrame が pickle（NumPy のブロック単位）で受け渡される
+    if max_workers is None:
+        max_workers = int(os.getenv("SHARD_MAX_WORKERS", "1"))
+    if max_workers <= 1 or df['seccode'].nunique() < 2:
+        return func(df)
+
+    shards = shard_by_seccode(df, max_workers)
+    logging.info(f"🧩 Running {getattr(func, '__name__', 'stage')} over {len(shards)} seccode shards with {max_workers} workers...")
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=dispose_engines) as executor:
+        results = list(executor.map(func, shards))
+    return pd.concat(results)